@@ -1,10 +1,23 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from itertools import zip_longest
 import datetime
-from dateutil.relativedelta import relativedelta
-from email.message import EmailMessage
+# csv, email, hashlib, mailer, concurrent.futures and matplotlib are imported where they're used,
+# adding an entry from the command line doesn't need them
 import json
-#from matplotlib import pyplot as plt
+import math
 import os
-import smtplib
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
 
 WELCOME = """Hello there!
 You went shopping, didn't you?
@@ -17,27 +30,323 @@ EMAIL_PASSWORD = os.environ.get('EMAIL_PASS')
 
 today = datetime.date.today()
 
+# New entries are appended to the journal, data.json is only rewritten
+# when the journal is folded into it (see compact_journal)
+JOURNAL_FILE = 'data.journal'
+JOURNAL_MAX_BYTES = 64 * 1024
+
+# What an entry holds after its total, unless settings.json lists its own
+# "categories", e.g. ["produce", "dairy", "household", "alcohol"].
+# A month's average in data["average"] follows the same order:
+# [average total, average of every category..., total of the month]
+DEFAULT_CATEGORIES = ("meat", "extra")
+CATEGORY_QUESTIONS = {
+    "meat": "How much did you spend on meat today? ",
+    "extra": "And how much was spent on extra items? ",
+}
+CATEGORY_DESCRIPTIONS = {"extra": "extra items"}
+
+# Entries of months older than the "keep_months" setting are moved here
+# (gzip, one json line a month) and only their aggregates stay in data.json
+ARCHIVE_FILE = 'data.archive.gz'
+
+# With the "storage": "shards" setting each month is kept in its own file here
+SHARD_DIR = 'data'
+
+# First bytes of a binary snapshot (binary_snapshot.MAGIC), load_json
+# and save_to_json use the binary format for such files
+BINARY_MAGIC = b"SSKB"
+
+# Rendered charts, named after a hash of what's drawn on them
+CHART_DIR = 'charts'
+
+# Timing of main()'s stages: "print" shows a summary at the end, any other
+# value is the path of a JSON-lines file the measurements are appended to.
+# Also turned on (with "print") by the --profile option.
+PROFILE = os.environ.get('SSK_PROFILE')
+metrics = []
+
 def main():
     print(WELCOME)
-    load_settings('settings.json')
-    collect_data(settings["vegetarian?"])
-    load_json()
-    save_new_entry(today, data, new)
-	
-    # Do statistics for the previous month if today's the first entry of the month (first check below)
-    # Second check below checks if there is any data existing before the current month
-    if len(data["weekly"][today.strftime("%B %Y")]) == 1 and len(data["weekly"]) > 1:
-        do_statistics(
-            settings["vegetarian?"], settings["currency"], 
-			settings["goal"], data, today
-        )
+    with stage("load_settings", read=['settings.json']):
+        load_settings('settings.json')
+    # a bad setting stops the program before anything is saved
+    keep_months_of(settings)
+    with stage("collect_data"):
+        collect_data(settings["vegetarian?"], categories_of(settings))
+
+    if settings.get("storage") == "sqlite":
+        main_sqlite()
+    elif settings.get("storage") == "shards":
+        main_shards()
+    else:
+        main_json()
     
     #make_graph()
     #send_email(today)
-    save_to_json('data.json', data)
-    change_goal('settings.json', settings)
+    with stage("change_goal", written=['settings.json']):
+        change_goal('settings.json', settings)
+    report_metrics()
     input("Hit the enter to exit. Thanks!")
 
+def main_json():
+    """Add the new entry to data.json (through its journal)
+    and make the monthly report if it's due.
+    """
+    with stage("load_json", read=['data.json', JOURNAL_FILE]):
+        load_json()
+    for warning in unusual_entry(data, new, settings["currency"], categories_of(settings)):
+        print(warning)
+    with stage("save_new_entry", written=[JOURNAL_FILE]):
+        save_new_entry(today, data, new, JOURNAL_FILE)
+	
+    # Do statistics for the previous month if today's the first entry of the month (first check below)
+    # Second check below checks if there is any data existing before the current month
+    if len(data["weekly"][month_name(month_key(today))]) == 1 and len(data["weekly"]) > 1:
+        with stage("do_statistics"):
+            do_statistics(
+                settings["vegetarian?"], settings["currency"], 
+                settings["goal"], data, today,
+                settings.get("window", 3), settings.get("gaps", "strict"),
+                categories_of(settings)
+            )
+        # "average" has changed, so fold the journal into a new snapshot
+        with stage("save_to_json", written=['data.json']):
+            compact_journal('data.json', JOURNAL_FILE, data)
+
+        keep_months = keep_months_of(settings)
+        if keep_months:
+            with stage("archive", written=['data.json', ARCHIVE_FILE]):
+                archive_old_months(today, keep_months)
+
+    elif os.path.getsize(JOURNAL_FILE) > JOURNAL_MAX_BYTES:
+        with stage("save_to_json", written=['data.json']):
+            compact_journal('data.json', JOURNAL_FILE, data)
+
+def stage(name, read=(), written=()):
+    """Context manager measuring one stage of main() when PROFILE is set:
+    wall time, the change in the number of allocated memory blocks and
+    the sizes of the files read and written. It does nothing otherwise.
+    """
+    if not PROFILE:
+        return nullcontext()
+    return _measured_stage(name, read, written)
+
+@contextmanager
+def _measured_stage(name, read, written):
+    read_bytes = sum(_file_size(path) for path in read)
+    blocks = sys.getallocatedblocks()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.append({
+            "stage": name,
+            "seconds": time.perf_counter() - start,
+            "allocated_blocks": sys.getallocatedblocks() - blocks,
+            "read_bytes": read_bytes,
+            "written_bytes": sum(_file_size(path) for path in written),
+        })
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def report_metrics():
+    """Print the measured stages or append them to the PROFILE file,
+    then start over.
+    """
+    if not metrics:
+        return
+
+    if PROFILE == "print":
+        print(f"{'stage':<16}{'ms':>10}{'blocks':>10}{'read':>12}{'written':>12}")
+        for m in metrics:
+            print(
+                f"{m['stage']:<16}{m['seconds'] * 1000:>10.2f}{m['allocated_blocks']:>10}"
+                f"{m['read_bytes']:>12}{m['written_bytes']:>12}"
+            )
+    else:
+        run = datetime.datetime.now().isoformat(timespec="seconds")
+        with open(PROFILE, 'a') as f:
+            for m in metrics:
+                f.write(json.dumps(dict(m, run=run)) + "\n")
+
+    metrics.clear()
+
+def main_sqlite():
+    """Same as main_json, but with the "storage": "sqlite" setting
+    the entries are kept in data.db and only the months
+    the report needs are loaded.
+    """
+    global data
+    import sqlite_storage
+
+    conn = sqlite_storage.connect('data.db')
+    with stage("save_new_entry", written=['data.db']):
+        sqlite_storage.save_entry(conn, today, new)
+    with stage("load_json", read=['data.db']):
+        data = sqlite_storage.load_report_window(conn, today, settings.get("window", 3))
+
+    if len(data["weekly"][month_name(month_key(today))]) == 1 and sqlite_storage.has_history(conn, today):
+        with stage("do_statistics"):
+            do_statistics(
+                settings["vegetarian?"], settings["currency"],
+                settings["goal"], data, today,
+                settings.get("window", 3), settings.get("gaps", "strict"),
+                categories_of(settings)
+            )
+        with stage("save_to_json", written=['data.db']):
+            sqlite_storage.save_averages(conn, data)
+
+    conn.close()
+
+def main_shards():
+    """Same as main_json, but with the "storage": "shards" setting
+    every month is a file in SHARD_DIR and only the current month,
+    the reported month and the months it's compared with are read.
+    """
+    global data
+
+    window = settings.get("window", 3)
+    current_shard = shard_file(SHARD_DIR, month_key(today))
+    with stage("save_new_entry", written=[current_shard]):
+        add_to_shard(SHARD_DIR, today, new)
+    with stage("load_json", read=[current_shard]):
+        data = load_window(SHARD_DIR, today, window)
+
+    if len(data["weekly"][month_name(month_key(today))]) == 1 and len(shard_months(SHARD_DIR)) > 1:
+        with stage("do_statistics"):
+            report = do_statistics(
+                settings["vegetarian?"], settings["currency"],
+                settings["goal"], data, today,
+                window, settings.get("gaps", "strict"), categories_of(settings)
+            )
+        with stage("save_to_json"):
+            save_shard_average(SHARD_DIR, data, report.report_month)
+
+def load_report_data(date):
+    """Load what the report on 'date' needs, from the storage of the
+    "storage" setting: the whole data.json, or only the months of the
+    report from data.db or the shards (see main_sqlite and main_shards).
+    """
+    global data
+
+    storage = settings.get("storage")
+    window = settings.get("window", 3)
+    if storage == "sqlite":
+        import sqlite_storage
+        conn = sqlite_storage.connect('data.db')
+        data = sqlite_storage.load_report_window(conn, date, window)
+        conn.close()
+    elif storage == "shards":
+        data = load_window(SHARD_DIR, date, window)
+    else:
+        load_json()
+    return data
+
+def save_report_data(report):
+    """Save the average a report stored in 'data', to the same storage
+    load_report_data read it from.
+    """
+    storage = settings.get("storage")
+    if storage == "sqlite":
+        import sqlite_storage
+        conn = sqlite_storage.connect('data.db')
+        sqlite_storage.save_averages(conn, data)
+        conn.close()
+    elif storage == "shards":
+        save_shard_average(SHARD_DIR, data, report.report_month)
+    else:
+        # "average" has changed, so fold the journal into a new snapshot
+        compact_journal('data.json', JOURNAL_FILE, data)
+
+def bulk_import(path, veg, json_file='data.json', journal_file=JOURNAL_FILE,
+                categories=DEFAULT_CATEGORIES):
+    """Import entries from a CSV file or a JSON-lines file (.jsonl)
+    without any questions. Every row needs a date (YYYY-MM-DD), total
+    and a column for every category (meat and extra by default);
+    the entry goes to the month of its own date.
+    Rows are checked like in collect_data and the bad ones are reported
+    and skipped. The file is read row by row and everything is saved once,
+    at the end, while the journal is locked. Returns the numbers of imported and rejected rows.
+    """
+    imported = rejected = 0
+    start = time.perf_counter()
+
+    # Other writers wait until the import is saved
+    with locked(journal_file):
+        data = to_columns(read_snapshot(json_file, journal_file))
+
+        for row_number, row in read_rows(path):
+            try:
+                date = datetime.date.fromisoformat(row["date"])
+                entry = parse_amounts(
+                    row["total"], {category: row.get(category) for category in categories},
+                    veg, categories
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                rejected += 1
+                print(f"Row {row_number} rejected: {e!r}")
+                continue
+
+            save_new_entry(date, data, entry)
+            imported += 1
+
+        write_snapshot(json_file, journal_file, data)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Imported {imported} rows, rejected {rejected} "
+        f"({(imported + rejected) / elapsed if elapsed else 0:.0f} rows/s)."
+    )
+    return imported, rejected
+
+def read_rows(path):
+    """Yield (row number, row dictionary) from a CSV or JSON-lines file,
+    one row at a time. Row numbers start at 1, CSV headers don't count.
+    """
+    import csv
+
+    with open(path, newline='') as f:
+        if path.endswith(".jsonl"):
+            for row_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield row_number, row
+        else:
+            yield from enumerate(csv.DictReader(f), 1)
+
+def parse_amounts(total, amounts, veg, categories=DEFAULT_CATEGORIES):
+    """Turn the total and the {category: amount} dictionary into an entry,
+    [total, amount of every category in 'categories' order], using the
+    rules of collect_data. Raises ValueError for a missing or unknown
+    category and for anything that isn't a whole number.
+    """
+    unknown = amounts.keys() - set(categories)
+    if unknown:
+        raise ValueError(f"unknown categories {', '.join(sorted(unknown))}")
+
+    entry = [int(str(total))]
+    for category in categories:
+        amount = amounts.get(category)
+        if category == "meat" and veg.lower() != "no":
+            if amount not in (None, "", 0, "0"):
+                raise ValueError(f"meat expenses of {amount} for a vegetarian")
+            entry.append(0)
+        elif amount is None:
+            raise ValueError(f"no amount for {category}")
+        else:
+            entry.append(int(str(amount)))
+
+    return entry
+
 def load_settings(json_file):
     """If it's the first time the program is run, 
     create a json to store the settings.
@@ -80,63 +389,71 @@ def load_settings(json_file):
             else:
                 print("Oops! I need a number, try again")
 
-        with open(json_file, 'w') as f:
-            json.dump(settings, f)
+        save_to_json(json_file, settings)
 
-def collect_data(veg):
-    """Ask three questions, make sure that the input is correct.
-    Assign a list of three answers to a variable 'new'.
+def categories_of(settings):
+    """The categories of a household's entries after the total, the
+    "categories" setting or DEFAULT_CATEGORIES. Raises ValueError if the
+    setting isn't a list of different names.
+    """
+    categories = settings.get("categories", DEFAULT_CATEGORIES)
+    if (
+        not isinstance(categories, (list, tuple))
+        or not all(isinstance(name, str) and name.strip() and name != "total" for name in categories)
+        or len(set(categories)) != len(categories)
+    ):
+        raise ValueError(f'"categories" must be a list of different names, not {categories!r}')
+    return tuple(categories)
+
+def keep_months_of(settings):
+    """The "keep_months" setting (see archive_old_months), None if there
+    is none. Raises ValueError if it isn't a whole number of at least 2.
+    """
+    keep_months = settings.get("keep_months")
+    if keep_months is not None and (
+        not isinstance(keep_months, int) or isinstance(keep_months, bool) or keep_months < 2
+    ):
+        raise ValueError(f'"keep_months" must be a whole number of at least 2, not {keep_months!r}')
+    return keep_months
+
+def collect_data(veg, categories=DEFAULT_CATEGORIES):
+    """Ask for the total and the amount of every category, make sure
+    that the input is correct.
+    Assign the list of answers to a variable 'new'.
     """
 
     global new
-    meat = 0 # default value for meat 
 
     while True:
 
-        while True:
-            try:
-                total = int(input("What was the total spent today? "))
-                break
-
-            except ValueError:
-                print("Oops! It wasn't a valid number, please try again.")
-
-        if veg.lower() == "no":
-            while True:
-                try:
-                    meat = int(input("How much did you spend on meat today? "))
-                    if meat == 0:
-                        print("Going vegeterian are you?")
-
-                    elif meat > 50:
-                        print("You promised to eat less meat, didn't you?")
-                    break
+        total = ask_amount("What was the total spent today? ")
 
-                except ValueError:
-                    print("Oops! It wasn't a valid number, please try again.")
-
-        while True:
-            try:
-                extra = int(input("And how much was spent on extra items? "))
-                break
+        amounts = []
+        for category in categories:
+            if category == "meat" and veg.lower() != "no":
+                amounts.append(0) # default value for meat
+                continue
 
-            except ValueError:
-                print("Oops! It wasn't a valid number, please try again.")
+            amount = ask_amount(
+                CATEGORY_QUESTIONS.get(category, f"How much did you spend on {category} today? ")
+            )
+            if category == "meat" and amount == 0:
+                print("Going vegeterian are you?")
+            amounts.append(amount)
+
+        spent = [
+            f"{amount} PLN on {CATEGORY_DESCRIPTIONS.get(category, category)}"
+            for category, amount in zip(categories, amounts)
+            if category != "meat" or veg.lower() == "no"
+        ]
 
         while True:
 
-            if veg.lower() == "no":
-                is_correct = input(
-                    "You spent {} PLN in total,"
-                                   "\n{} PLN on meat and {} PLN on extra items. Is that correct?"
-                                   "\nEnter Yes or No. ".format(str(total), str(meat), str(extra))
-                )
-            else:
-                is_correct = input(
-                    "You spent {} PLN in total,"
-                                   "\nand {} PLN was on extra items. Is that correct?"
-                                   "\nEnter Yes or No. ".format(str(total), str(extra))
-                )
+            is_correct = input(
+                f"You spent {total} PLN in total"
+                + (f",\n{join_words(spent)}" if spent else "")
+                + ". Is that correct?\nEnter Yes or No. "
+            )
 
             if is_correct.lower() in ["yes", "no"]:
                 break
@@ -151,172 +468,1308 @@ def collect_data(veg):
         else:
             print("Let's start over then")
 
-    new = [total, meat, extra]
+    new = [total] + amounts
+
+def ask_amount(question):
+    """Ask until the answer is a whole number."""
+    while True:
+        try:
+            return int(input(question))
 
+        except ValueError:
+            print("Oops! It wasn't a valid number, please try again.")
 
-def load_json():
+def join_words(words):
+    """'a', 'a and b', 'a, b and c'..."""
+    return " and ".join(filter(None, [", ".join(words[:-1]), words[-1]])) if words else ""
+
+def load_json(json_file='data.json', journal_file=JOURNAL_FILE):
     """Load the json file.
-    If it's the first time the program is used, create a new json file.
+    If it's the first time the program is used, the history is empty
+    (the json file is created when it's first saved).
     The dictionary 'data' has two keys: 'weekly' is for storing weekly
     statistics for each month. 'average' key is used for memoization of average
     monthly values. Lists (only one a month) in "average" have 4 values:
     average total sum spent every week, average meat and extra items expenses
     and the total of money spent in the month.
+    The json file is only a snapshot, entries added since it was written
+    are replayed from the journal on top of it.
     """
+    global data
+
+    data = read_snapshot(json_file, journal_file)
+    return data
+
+def read_snapshot(json_file, journal_file):
+    """The snapshot with the journal replayed on top of it (see load_json)."""
     try:
-        with open('data.json') as f:
-            global data
-            data = json.load(f)
+        with open(json_file, 'rb') as f:
+            content = f.read()
 
     except FileNotFoundError:
-        data = {"weekly": {}, "average": {}}
-        with open('data.json', 'w') as f:
-            json.dump(data, f)
+        # nothing is written here, the first locked save creates the file
+        snapshot = {"weekly": {}, "average": {}}
+
+    else:
+        snapshot = parse_snapshot(content)
+
+    if "running" not in snapshot:
+        rebuild_aggregates(snapshot)
+    if "stats" not in snapshot:
+        rebuild_stats(snapshot)
+    if "rollup" not in snapshot:
+        rebuild_rollup(snapshot)
+
+    for date, entry in read_journal(journal_file, snapshot.get("journal_generation", 0)):
+        save_new_entry(date, snapshot, entry)
+
+    return snapshot
+
+def parse_snapshot(content):
+    """The dictionary in the bytes of a json file or a binary snapshot."""
+    if content.startswith(BINARY_MAGIC):
+        import binary_snapshot
+        return binary_snapshot.loads(content)
+    return json.loads(content)
+
+def read_journal(journal_file, generation=0):
+    """Yield (date, entry) pairs from the journal in the order they were added.
+    A half-written line (the program was killed while appending)
+    is skipped. A journal older than 'generation' (see write_snapshot)
+    is already in the snapshot and nothing is yielded.
+    """
+    try:
+        with open(journal_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "generation" in record:
+                    if record["generation"] < generation:
+                        return
+                    continue
+                yield datetime.date.fromisoformat(record["date"]), record["entry"]
+
+    except FileNotFoundError:
+        return
+
+def append_to_journal(journal_file, date, new_entry):
+    """Append a single entry to the journal, one json object per line.
+    This costs the same no matter how long the history in data.json is.
+    """
+    append_entries_to_journal(journal_file, [(date, new_entry)])
+
+def append_entries_to_journal(journal_file, entries):
+    """Append many (date, entry) pairs to the journal with one write.
+    A half-written last line is ended first, so it can't swallow the
+    first of the new lines.
+    """
+    lines = "".join(
+        json.dumps({"date": date.isoformat(), "entry": new_entry}) + "\n"
+        for date, new_entry in entries
+    )
+    with locked(journal_file):
+        with open(journal_file, 'ab+') as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    lines = "\n" + lines
+            f.write(lines.encode())
+
+def compact_journal(json_file, journal_file, data=None):
+    """Fold the journal into a new snapshot: write the whole dictionary
+    to the json file and start an empty journal.
+    The snapshot and the journal are read again while the journal is
+    locked, so entries other processes added since 'data' was loaded
+    are kept, and all of them are written at once. Only the averages
+    (and their stats) are taken from 'data'. Returns the new snapshot.
+    """
+    with locked(journal_file):
+        snapshot = read_snapshot(json_file, journal_file)
+        if data is not None:
+            snapshot["average"].update(data["average"])
+            if "stats" in data:
+                snapshot["stats"]["months"] = data["stats"]["months"]
+                snapshot["stats"]["last_month"] = data["stats"]["last_month"]
+        write_snapshot(json_file, journal_file, snapshot)
+    return snapshot
+
+def write_snapshot(json_file, journal_file, data):
+    """Replace the snapshot with 'data' and empty the journal.
+    The caller must hold the journal's lock and 'data' must contain
+    everything that is in the journal.
+    Every snapshot counts its "journal_generation" up and the emptied
+    journal starts with the same number, so if the program is killed
+    between the two writes the old journal, already in the snapshot,
+    is not replayed again.
+    """
+    data["journal_generation"] = data.get("journal_generation", 0) + 1
+    save_to_json(json_file, data)
+    with open(journal_file, 'w') as f:
+        f.write(json.dumps({"generation": data["journal_generation"]}) + "\n")
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive lock on 'path' (through path + '.lock') for the
+    duration of the with block. Other processes using locked() on the
+    same path wait for it.
+    """
+    with open(path + '.lock', 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 			
-def save_new_entry(date, data, new_entry):
+def shard_file(shard_dir, key):
+    return os.path.join(shard_dir, f"{key // 12:04d}-{key % 12 + 1:02d}.json")
+
+def shard_months(shard_dir):
+    """MonthIndex of the months that have a shard, read from the file names only."""
+    index = MonthIndex()
+    if os.path.isdir(shard_dir):
+        for name in os.listdir(shard_dir):
+            year, _, month = name[:-len(".json")].partition("-")
+            if name.endswith(".json") and year.isdigit() and month.isdigit():
+                index.add(int(year) * 12 + int(month) - 1)
+    return index
+
+def save_shards(shard_dir, data, months=None):
+    """Write the given months (all of them by default) of the dictionary
+    to their own files in 'shard_dir', e.g. 2019-04.json for April 2019.
+    Each file keeps the month's "weekly", "average" and "running" values.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    if months is None:
+        months = data["weekly"].keys() | data["average"].keys()
+
+    for month in months:
+        shard = {key: data[key][month] for key in ("weekly", "average", "running")
+                 if month in data.get(key, {})}
+        save_to_json(shard_file(shard_dir, parse_month(month)), shard)
+
+def load_shards(shard_dir, keys):
+    """Load only the months with the given month keys into a dictionary
+    in the load_json format. Months without a shard are left out.
+    """
+    data = {"weekly": {}, "average": {}, "running": {}}
+
+    for key in keys:
+        try:
+            with open(shard_file(shard_dir, key)) as f:
+                shard = json.load(f)
+        except FileNotFoundError:
+            continue
+        for part, value in shard.items():
+            data[part][month_name(key)] = value
+
+    return data
+
+def load_window(shard_dir, date, window=3):
+    """Load the months a run on 'date' can use: the current month,
+    the reported month and the 'window' months it is compared with.
+    """
+    current = month_key(date)
+    return load_shards(shard_dir, range(current - window - 1, current + 1))
+
+def add_to_shard(shard_dir, date, new_entry):
+    """Add one entry to the shard of its month. The shard is read and
+    written while it's locked, so entries added at the same time by
+    other processes aren't lost. Returns the month as a dictionary.
+    """
+    key = month_key(date)
+    os.makedirs(shard_dir, exist_ok=True)
+    with locked(shard_file(shard_dir, key)):
+        month = load_shards(shard_dir, [key])
+        save_new_entry(date, month, new_entry)
+        save_shards(shard_dir, month, [month_name(key)])
+    return month
+
+def save_shard_average(shard_dir, data, month):
+    """Store the average of 'month' from 'data' in its shard. The shard
+    is read again while it's locked, so entries added since 'data' was
+    loaded are kept.
+    """
+    key = parse_month(month)
+    with locked(shard_file(shard_dir, key)):
+        shard = load_shards(shard_dir, [key])
+        shard["average"][month] = data["average"][month]
+        save_shards(shard_dir, shard, [month])
+
+def split_json(json_file, shard_dir, journal_file=JOURNAL_FILE):
+    """Turn a data.json (and its journal) into one shard per month."""
+    save_shards(shard_dir, load_json(json_file, journal_file))
+
+def save_new_entry(date, data, new_entry, journal_file=None):
     """Display the date in the format 'month year'.
     Create a new list for this month if it's the first shopping of the month,
     otherwise append this month's list with the new entry.
     The new entry is stored as a list in the variable 'new'.
+    Running aggregates of the month, the streaming statistics and the
+    rollup are updated too, if the dictionary keeps them (see load_json).
+    If a journal file is given, the entry is also appended to it,
+    so there is no need to save the whole dictionary afterwards.
     """
 
-    if date.strftime("%B %Y") in data["weekly"]:
-        data["weekly"][date.strftime("%B %Y")].append(new_entry)
+    if journal_file is not None:
+        append_to_journal(journal_file, date, new_entry)
+
+    month = month_name(month_key(date))
+
+    if "running" in data:
+        update_aggregates(data, month, new_entry)
+    if "stats" in data:
+        add_values(data["stats"]["trips"], new_entry)
+    if "rollup" in data:
+        update_rollup(data, date, new_entry)
+
+    if month in data["weekly"]:
+        data["weekly"][month].append(new_entry)
         return data #tests were failing to recognise this variable when there is no return
     else:
-        data["weekly"][date.strftime("%B %Y")] = [new_entry]
+        data["weekly"][month] = [new_entry]
         return data
 
+MONTH_NAMES = (
+    "January", "February", "March", "April", "May", "June", "July",
+    "August", "September", "October", "November", "December"
+)
+_MONTH_NUMBERS = {name: number for number, name in enumerate(MONTH_NAMES)}
 
-        
-def do_statistics(veg, curr, g, data, date):
+def month_key(date):
+    """Number of the month of 'date' counted from year 0 (year * 12 + month - 1).
+    Month keys can be compared, sorted and subtracted, and the previous
+    month of 'key' is simply key - 1.
     """
-    Compare last month's average to the average of the 3 previous months.
-    If there are not enough records, display a shorter message, otherwise
-    show the longer version.
-    aver_total_3_months = average total of the 3 months before the reported month
-    aver_meat_3_months = average meat expenses in the same period
-    aver_extra_3_months = average extra items expenses in the same period
+    return date.year * 12 + date.month - 1
+
+def month_name(key):
+    """The 'month year' name of a month key, as used in the json file.
+    The English names are always used, whatever the locale.
     """
+    return f"{MONTH_NAMES[key % 12]} {key // 12}"
 
-    global onemonth_before, twomonths_before, threemonths_before, report_month, msg_content, num_of_entries
-    global total, aver_meat, aver_extra, aver_total
+def parse_month(name):
+    """Month key of a 'month year' name from the json file.
+    Files written by older versions under another locale still load,
+    their month names are read with the current locale.
+    """
+    month, _, year = name.rpartition(" ")
+    try:
+        return int(year) * 12 + _MONTH_NUMBERS[month]
+    except KeyError:
+        return month_key(datetime.datetime.strptime(name, "%B %Y"))
+
+class MonthIndex:
+    """Sorted month keys, for finding the months before a given one
+    or the months in a range with a binary search.
+    """
+
+    __slots__ = ("keys",)
 
-    report_month = (date - relativedelta(months=1)).strftime("%B %Y")
+    def __init__(self, months=()):
+        self.keys = sorted({parse_month(month) for month in months})
 
-    num_of_entries = len(data["weekly"][report_month])
+    def add(self, key):
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            self.keys.insert(i, key)
 
-    onemonth_before = (date - relativedelta(months=2)).strftime("%B %Y")
+    def before(self, key, n):
+        """The (at most) n months with data just before 'key', oldest first."""
+        i = bisect_left(self.keys, key)
+        return self.keys[max(0, i - n):i]
 
-    twomonths_before = (date - relativedelta(months=3)).strftime("%B %Y")
+    def between(self, first, last):
+        """The months from 'first' to 'last', both included."""
+        return self.keys[bisect_left(self.keys, first):bisect_right(self.keys, last)]
 
-    threemonths_before = (date - relativedelta(months=4)).strftime("%B %Y")                          
+    def __contains__(self, key):
+        i = bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
 
-    total = 0  
-    total_meat = 0 
-    total_extra = 0
+    def __len__(self):
+        return len(self.keys)
 
-    for item in data["weekly"][report_month]:
-        total += item[0]
-        total_meat += item[1]
-        total_extra += item[2]
+    def __iter__(self):
+        return iter(self.keys)
 
-    aver_total = round(total / num_of_entries)
-    aver_meat = round(total_meat / num_of_entries)
-    aver_extra = round(total_extra / num_of_entries)
+def month_index(data):
+    """MonthIndex of all the months with entries or averages."""
+    return MonthIndex(data["weekly"].keys() | data["average"].keys())
+
+
+
+class MonthColumns:
+    """A month of entries stored column by column, one typed array each
+    for the totals and every category. It can be used wherever the list
+    of [total, meat, extra] lists is used (len, iteration, append),
+    but it takes a fraction of the memory and its sums run in C.
+    Months loaded from a binary snapshot and the ones bulk_import works
+    on are MonthColumns, a json data.json is still loaded as lists.
+    """
 
-    data["average"][report_month] = [
-        aver_total, aver_meat, aver_extra, total
+    __slots__ = ("columns",)
+
+    def __init__(self, entries=()):
+        self.columns = tuple(array('q', column) for column in _transpose(entries))
+
+    @classmethod
+    def from_columns(cls, columns):
+        """MonthColumns using the given arrays (of equal length) as they are,
+        e.g. the 4-byte ones of a binary snapshot.
+        """
+        month = cls.__new__(cls)
+        month.columns = tuple(columns)
+        return month
+
+    def append(self, entry):
+        if len(entry) != len(self.columns) and not len(self):
+            self.columns = tuple(array('q') for _ in entry)
+        elif self.columns[0].typecode != 'q' and any(not -2**31 <= value < 2**31 for value in entry):
+            # loaded as 4-byte integers, too small for this entry
+            self.columns = tuple(array('q', column) for column in self.columns)
+        if len(entry) > len(self.columns):
+            # a category added later, the earlier entries spent 0 on it
+            self.columns += tuple(
+                array('q', [0]) * len(self) for _ in range(len(entry) - len(self.columns))
+            )
+        for column, value in zip_longest(self.columns, entry, fillvalue=0):
+            column.append(value)
+
+    def sums(self):
+        return [sum(column) for column in self.columns]
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        return (list(entry) for entry in zip(*self.columns))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"MonthColumns({list(self)!r})"
+
+def _transpose(entries, width=3):
+    """Turn a list of entries into a list of columns. Entries narrower
+    than the others (saved before a category was added) count as 0 in
+    the missing columns.
+    """
+    return list(zip_longest(*entries, fillvalue=0)) or [()] * width
+
+def _to_json(obj):
+    """Let json.dump write MonthColumns as the usual list of lists."""
+    if isinstance(obj, MonthColumns):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def to_columns(data):
+    """Replace every month in data["weekly"] with MonthColumns.
+    Worth doing for long (e.g. imported) histories, save_to_json writes
+    the usual json either way.
+    """
+    for month, entries in data["weekly"].items():
+        if not isinstance(entries, MonthColumns):
+            data["weekly"][month] = MonthColumns(entries)
+    return data
+
+def month_sums(entries):
+    """Sums of the totals and of every category of one month."""
+    if isinstance(entries, MonthColumns):
+        return entries.sums()
+    return [sum(column) for column in _transpose(entries)]
+
+def monthly_sums(data, months):
+    """Number of entries and the sums of every column for each of the given
+    months, as {month: [count, total, meat, extra]}. Months without data
+    are left out.
+    """
+    result = {}
+    for month in months:
+        entries = data["weekly"].get(month)
+        if entries:
+            result[month] = [len(entries)] + month_sums(entries)
+    return result
+
+def monthly_averages(data, months):
+    """Averages of the given months in the format used by data["average"]:
+    [average total, average meat, average extra, total of the month].
+    The weekly entries are used, so it also works for months that were
+    never reported on.
+    """
+    return {
+        month: average_row(count, sums)
+        for month, (count, *sums) in monthly_sums(data, months).items()
+    }
+
+def average_row(count, sums):
+    """The data["average"] row of a month from its number of entries and
+    the sums of its columns: the average of every column and the total.
+    """
+    return [round(column / count) for column in sums] + [sums[0]]
+
+def update_aggregates(data, month, new_entry):
+    """Add one entry to the running aggregates of its month.
+    data["running"] keeps [number of entries, total, meat, extra]
+    (a sum for every category) for every month, so the month never has
+    to be scanned again.
+    """
+    add_to_sums(data["running"], month, new_entry)
+
+def add_to_sums(table, key, new_entry, count=1):
+    """Add one entry (or the sums of 'count' entries) to table[key],
+    a [number of entries, sums...] list.
+    """
+    sums = table.get(key)
+    if sums is None:
+        table[key] = [count] + list(new_entry)
+    else:
+        sums[0] += count
+        sums.extend([0] * (len(new_entry) + 1 - len(sums)))
+        for i, value in enumerate(new_entry, 1):
+            sums[i] += value
+
+def rebuild_aggregates(data):
+    """Compute data["running"] from scratch out of data["weekly"].
+    Archived months (see archive_old_months) keep their aggregates,
+    which also count the entries added to them after they were archived.
+    """
+    running = data.get("running", {})
+    archived = {month: running[month] for month in data.get("archived", ()) if month in running}
+    data["running"] = {**monthly_sums(data, data["weekly"]), **archived}
+    return data
+
+def check_aggregates(data, repair=True):
+    """Compare the running aggregates with data["weekly"] and return
+    the months where they differ. If 'repair' is true they are rebuilt.
+    Archived months have no entries to compare with and are skipped.
+    """
+    expected = monthly_sums(data, data["weekly"])
+    running = data.get("running", {})
+    archived = set(data.get("archived", ()))
+    drifted = sorted(
+        month for month in expected.keys() | running.keys()
+        if month not in archived and expected.get(month) != running.get(month)
+    )
+    if drifted and repair:
+        rebuild_aggregates(data)
+    return drifted
+
+def month_totals(data, month):
+    """[number of entries, total, meat, extra] of the month, read from
+    the running aggregates when they are there.
+    """
+    if month in data.get("running", {}):
+        return list(data["running"][month])
+    entries = data["weekly"][month]
+    return [len(entries)] + month_sums(entries)
+
+def month_summary(data, month):
+    """Averages of a month, also one still in progress, in the format of
+    data["average"]: [average total, average meat, average extra, total].
+    """
+    count, *sums = month_totals(data, month)
+    return average_row(count, sums)
+
+# Streaming statistics in data["stats"]: for every value of an entry
+# ("trips") and of a data["average"] row ("months") the count, mean and
+# sum of squared differences (Welford) and a quantile sketch whose bins
+# are powers of SKETCH_GAMMA, so any quantile is known within
+# SKETCH_ACCURACY (1%) of its value and sketches of different households
+# can simply be added up.
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# A value is unusual when it's further than UNUSUAL_DEVIATIONS standard
+# deviations from the mean of at least UNUSUAL_MIN_COUNT earlier values
+UNUSUAL_DEVIATIONS = 3
+UNUSUAL_MIN_COUNT = 10
+
+def new_stat():
+    return {"count": 0, "mean": 0.0, "m2": 0.0, "zeros": 0, "bins": {}}
+
+def add_value(stat, value):
+    """Add one value to a stat in O(1)."""
+    stat["count"] += 1
+    delta = value - stat["mean"]
+    stat["mean"] += delta / stat["count"]
+    stat["m2"] += delta * (value - stat["mean"])
+
+    if value <= 0:
+        stat["zeros"] += 1
+    else:
+        # the keys are strings, like they come back from json
+        key = str(math.ceil(math.log(value, SKETCH_GAMMA)))
+        stat["bins"][key] = stat["bins"].get(key, 0) + 1
+
+def merge_stats(first, second):
+    """A stat of the values of both, as if they were added one by one."""
+    count = first["count"] + second["count"]
+    if count == 0:
+        return new_stat()
+    delta = second["mean"] - first["mean"]
+    bins = dict(first["bins"])
+    for key, number in second["bins"].items():
+        bins[key] = bins.get(key, 0) + number
+
+    return {
+        "count": count,
+        "mean": first["mean"] + delta * second["count"] / count,
+        "m2": first["m2"] + second["m2"] + delta * delta * first["count"] * second["count"] / count,
+        "zeros": first["zeros"] + second["zeros"],
+        "bins": bins,
+    }
+
+def deviation(stat):
+    """Sample standard deviation of the values."""
+    return math.sqrt(stat["m2"] / (stat["count"] - 1)) if stat["count"] > 1 else 0.0
+
+def quantile(stat, q):
+    """The value below which the 'q' (0 to 1) part of the values lies,
+    within SKETCH_ACCURACY. Raises ValueError for an empty stat.
+    """
+    if stat["count"] == 0:
+        raise ValueError("there are no values")
+    rank = q * (stat["count"] - 1)
+    seen = stat["zeros"]
+    if rank < seen:
+        return 0
+    for key in sorted(stat["bins"], key=int):
+        seen += stat["bins"][key]
+        if rank < seen:
+            return round(2 * SKETCH_GAMMA ** int(key) / (SKETCH_GAMMA + 1))
+
+def add_values(stats, values):
+    """Add a row of values to a list of stats, one per column."""
+    for _ in range(len(values) - len(stats)):
+        stats.append(new_stat())
+    for stat, value in zip(stats, values):
+        add_value(stat, value)
+
+def unusual_values(stats, values):
+    """Columns of 'values' far from what the stats have seen so far,
+    as [(column, value, rounded mean)].
+    """
+    unusual = []
+    for column, (stat, value) in enumerate(zip(stats, values)):
+        spread = deviation(stat)
+        if (stat["count"] >= UNUSUAL_MIN_COUNT and spread
+                and abs(value - stat["mean"]) > UNUSUAL_DEVIATIONS * spread):
+            unusual.append((column, value, round(stat["mean"])))
+    return unusual
+
+def rebuild_stats(data):
+    """Compute data["stats"] from scratch out of every entry and average.
+    The cached reports are dropped, their unusual values came from the old stats.
+    """
+    forget_reports()
+    stats = data["stats"] = {"trips": [], "months": [], "last_month": None}
+    for entries in data["weekly"].values():
+        for entry in entries:
+            add_values(stats["trips"], entry)
+    for key in MonthIndex(data["average"]):
+        add_month_stats(data, key)
+    return data
+
+def add_month_stats(data, key):
+    """Add the average of the month 'key' to the month stats, unless
+    a later month is already there (a month is only counted once).
+    """
+    stats = data["stats"]
+    if stats["last_month"] is None or key > stats["last_month"]:
+        add_values(stats["months"], data["average"][month_name(key)])
+        stats["last_month"] = key
+
+def unusual_entry(data, entry, curr, categories=DEFAULT_CATEGORIES):
+    """Messages about the values of a new entry that are unusual for the
+    household, compared with data["stats"] before the entry is added.
+    """
+    if "stats" not in data:
+        return []
+    names = ["in total"] + [f"on {CATEGORY_DESCRIPTIONS.get(category, category)}" for category in categories]
+    return [
+        f"That's unusual: {value} {curr} {names[column]}, usually it's about {mean} {curr}."
+        for column, value, mean in unusual_values(data["stats"]["trips"], entry)
+        if column < len(names)
     ]
+        
+# Sums of the entries by ISO week, quarter and year in data["rollup"],
+# {level: {period: [number of entries, total, meat, extra]}}, kept up to
+# date entry by entry like data["running"] is for the months. Periods are
+# labelled "2019-W18", "April 2019" (the month level is data["running"]),
+# "2019-Q2" and "2019".
+ROLLUP_LEVELS = ("week", "quarter", "year")
+# How many periods back the same period of the year before is
+PERIODS_A_YEAR = {"week": 52, "month": 12, "quarter": 4, "year": 1}
+
+def period_label(level, date):
+    """The label of the week, month, quarter or year 'date' is in."""
+    if level == "week":
+        year, week, _ = date.isocalendar()
+        return f"{year}-W{week:02d}"
+    if level == "month":
+        return month_name(month_key(date))
+    if level == "quarter":
+        return f"{date.year}-Q{(date.month - 1) // 3 + 1}"
+    if level == "year":
+        return str(date.year)
+    raise ValueError(f"level must be week, month, quarter or year, not {level!r}")
+
+def previous_periods(level, date, count):
+    """Labels of the 'count' periods before the one 'date' is in, oldest first."""
+    if level == "week":
+        monday = date - datetime.timedelta(days=date.weekday())
+        days = [monday - datetime.timedelta(weeks=i) for i in range(count, 0, -1)]
+    elif level == "year":
+        days = [datetime.date(date.year - i, 1, 1) for i in range(count, 0, -1)]
+    else:
+        length = 3 if level == "quarter" else 1
+        first = month_key(date) - (date.month - 1) % length
+        days = [
+            datetime.date(key // 12, key % 12 + 1, 1)
+            for key in (first - length * i for i in range(count, 0, -1))
+        ]
+    return [period_label(level, day) for day in days]
 
-    try:
-        aver_total_3_months = round((data['average'][onemonth_before][0] +
-             data['average'][twomonths_before][0] +
-             data['average'][threemonths_before][0]) / 3)
+def update_rollup(data, date, new_entry):
+    """Add one entry to its week, quarter and year in data["rollup"]."""
+    for level in ROLLUP_LEVELS:
+        add_to_sums(data["rollup"][level], period_label(level, date), new_entry)
+
+def rebuild_rollup(data):
+    """Compute the quarters and years of data["rollup"] from data["running"].
+    data.json doesn't know the days of its entries, so weeks are only
+    counted for the entries added after this.
+    """
+    data["rollup"] = {level: {} for level in ROLLUP_LEVELS}
+    for month, (count, *sums) in data.get("running", {}).items():
+        key = parse_month(month)
+        first_day = datetime.date(key // 12, key % 12 + 1, 1)
+        for level in ("quarter", "year"):
+            add_to_sums(data["rollup"][level], period_label(level, first_day), sums, count)
+    return data
+
+def rollup(data, level, label):
+    """[number of entries, total, meat, extra] of one period, or None."""
+    table = data["running"] if level == "month" else data["rollup"][level]
+    return table.get(label)
+
+def period_series(data, level, labels):
+    """Same lines as graph_series, for periods of the rollup: average
+    totals, the average of every category and the totals.
+    Raises KeyError if nothing was bought in a period.
+    """
+    if level == "month":
+        return graph_series(data, labels)
+    rows = []
+    for label in labels:
+        sums = rollup(data, level, label)
+        if not sums:
+            raise KeyError(label)
+        rows.append(average_row(sums[0], sums[1:]))
+    return series_columns(rows)
+
+def period_report(data, level, date, curr, categories=DEFAULT_CATEGORIES):
+    """Compare the last week, month, quarter or year before 'date' with
+    the one before it and with the same period a year earlier, all read
+    from the rollup. Returns None if nothing was bought in it.
+    """
+    labels = previous_periods(level, date, PERIODS_A_YEAR[level] + 1)
+    last = rollup(data, level, labels[-1])
+    if not last:
+        return None
+
+    count, total, *sums = last
+    spent = [
+        f"{amount} {curr} on {CATEGORY_DESCRIPTIONS.get(category, category)}"
+        for category, amount in zip(categories, sums)
+    ]
+    msg_content = (
+        f"In {labels[-1]} you spent {total} {curr} in {count} shopping trips, "
+        f"{round(total / count)} {curr} a trip"
+        + (f", {join_words(spent)}" if spent else "") + "."
+    )
+
+    for label in dict.fromkeys([labels[-2], labels[0]]):
+        earlier = rollup(data, level, label)
+        if earlier and earlier[1]:
+            change = round((total - earlier[1]) / earlier[1] * 100)
+            msg_content += (
+                f"\nThat's {abs(change)}% {'more' if change >= 0 else 'less'} "
+                f"than in {label} ({earlier[1]} {curr})."
+            )
+    return msg_content
+
+# aver_meat and aver_extra are None when they aren't among the categories,
+# 'categories' holds (category, average, average of the compared months
+# or None) for every category
+Report = namedtuple("Report", [
+    "report_month", "onemonth_before", "twomonths_before", "threemonths_before",
+    "num_of_entries", "total", "aver_total", "aver_meat", "aver_extra", "msg_content",
+    "categories"
+], defaults=[()])
+
+def do_statistics(veg, curr, g, data, date, window=3, gaps="strict", categories=DEFAULT_CATEGORIES):
+    """Make the report for the previous month (see compute_report),
+    print it and keep its values in module variables for make_graph
+    and send_email.
+    """
+
+    global onemonth_before, twomonths_before, threemonths_before, report_month, msg_content, num_of_entries
+    global total, aver_meat, aver_extra, aver_total
+
+    report = compute_report(veg, curr, g, data, date, window, gaps, categories=categories)
+    (report_month, onemonth_before, twomonths_before, threemonths_before,
+     num_of_entries, total, aver_total, aver_meat, aver_extra, msg_content) = report[:10]
+
+    print(msg_content)
+    return report
+
+# Reports already made, see compute_report
+REPORT_CACHE_SIZE = 256
+_report_cache = OrderedDict()
+
+def forget_reports():
+    """Drop every cached report."""
+    _report_cache.clear()
+
+def month_stats_state(data):
+    """What the unusual values of a report depend on in data["stats"]:
+    the last month counted and every column's count, mean and spread.
+    """
+    if "stats" not in data:
+        return None
+    stats = data["stats"]
+    return stats["last_month"], tuple((stat["count"], stat["mean"], stat["m2"]) for stat in stats["months"])
+
+def compute_report(veg, curr, g, data, date, window=3, gaps="strict", rolling=None, tenant=None,
+                   categories=DEFAULT_CATEGORIES):
+    """
+    Compare last month's average to the average of the 3 (or 'window')
+    previous months. If there are not enough records, make a shorter
+    message, otherwise the longer version. See RollingWindow for 'gaps'.
+    The total and every one of the 'categories' (the columns of the
+    entries after the total) are averaged and compared at once, as rows
+    of sums, so any number of categories costs the same passes.
+    A RollingWindow already built for the whole history can be passed
+    as 'rolling' when reports for many months are made.
+    Only 'data' is changed (the average of the reported month is stored),
+    everything else is returned as a Report, so reports of different
+    households can be made at the same time.
+    The last REPORT_CACHE_SIZE reports are kept, keyed by 'tenant' (or the
+    'data' dictionary itself without one), the month, the settings and the
+    numbers and month stats they were made from, so asking again for an
+    unchanged month returns the same Report without computing anything.
+    Raises KeyError if nothing was bought in the reported month.
+    """
 
-        aver_meat_3_months = round((data['average'][onemonth_before][1] +
-             data['average'][twomonths_before][1] +
-             data['average'][threemonths_before][1]) / 3)
+    report_key = month_key(date) - 1
+
+    report_month = month_name(report_key)
+
+    num_of_entries, *sums = month_totals(data, report_month)
+    if not num_of_entries:
+        raise KeyError(report_month)
+    total = sums[0]
+
+    if rolling is not None:
+        window, gaps = rolling.window, rolling.gaps
+    cache_key = (
+        id(data) if tenant is None else tenant,
+        report_month, veg, curr, g, window, gaps, tuple(categories),
+        (num_of_entries, *sums), month_stats_state(data),
+        tuple(tuple(data["average"].get(month_name(key), ()))
+              for key in range(report_key - window, report_key))
+    )
+    report = _report_cache.get(cache_key)
+    if report is not None:
+        _report_cache.move_to_end(cache_key)
+        data["average"][report_month] = average_row(num_of_entries, sums)
+        return report
+
+    onemonth_before = month_name(report_key - 1)
+
+    twomonths_before = month_name(report_key - 2)
+
+    threemonths_before = month_name(report_key - 3)
+
+
+    averages = average_row(num_of_entries, sums)
+    data["average"][report_month] = averages
+    # compared with the months before it, only then it's counted itself
+    unusual = unusual_month(data, averages, curr, categories)
+    if "stats" in data:
+        add_month_stats(data, report_key)
+
+    aver_total = averages[0]
+    # months from before a category was added have no column for it
+    category_averages = _fit(averages[1:-1], len(categories))
+
+    if rolling is None:
+        rolling = RollingWindow(data, window, gaps, report_key - window, report_key - 1)
+    window = rolling.window
+
+    compared = rolling.compare(report_key)
+    compared_months = rolling.count(report_key)
+    if compared is not None:
+        aver_total_3_months, *compared_categories = compared
+        compared_categories = _fit(compared_categories, len(categories))
+    else:
+        compared_categories = [None] * len(categories)
+    report_categories = tuple(zip(categories, category_averages, compared_categories))
 
-        aver_extra_3_months = round((data['average'][onemonth_before][2] +
-             data['average'][twomonths_before][2] +
-             data['average'][threemonths_before][2]) / 3)
+    if compared is not None:
 
         msg_content = (
             f"Ready for some statistics? There were {str(num_of_entries)} "
             "shopping days "
             f"last month.\nThis is how last month's expenses compare to "
-            f"the average of the previous 3 months..."
+            f"the average of {_previous_months(compared_months)}..."
             f"\nLast month's total average is {str(aver_total)} {curr}, "
             f"compared to {str(aver_total_3_months)} {curr} "
-            f"in the previous months.\nMeat expenses: "
-            f"{str(aver_meat)} {curr} last month "
-            f"and {str(aver_meat_3_months)} {curr} in the previous 3 months."
-            f"\nYou spent on average {str(aver_extra)} {curr} a week on extra items, "
-            f"{str(aver_extra_3_months)} {curr} in the compared period."
+            f"in the previous months."
+            + "".join(
+                _category_line(category, average, previous, curr, compared_months)
+                for category, average, previous in report_categories
+            ) +
             f"\nIn total you spent {str(total)} last month. "
-            f"In {onemonth_before} it was {str(data['average'][onemonth_before][3])}. "
+            + (f"In {onemonth_before} it was {str(data['average'][onemonth_before][-1])}. "
+               if onemonth_before in data['average'] else "") +
             f"Your goal is to spend no more than {g}. So "
             f"{'congrats.' if total <= int(g) else 'better luck next time.'}"
+            + unusual
         )
 
-        print(msg_content)
-
-    except KeyError:
+    else:
+        spent = [
+            f"{average} on {CATEGORY_DESCRIPTIONS.get(category, category)}"
+            for category, average, _ in report_categories
+        ]
         msg_content = (
             f"Ready for statistics?\nThere were {str(num_of_entries)} shopping "
             f"days last month.\nYou spent {str(total)} {curr} in total. "
             f"Your goal is to spend no more than {g}, "
             f"so {'congrats.' if total <= int(g) else 'better luck next time.'}"
-            f"\nOn average you spent {str(aver_total)} {curr} a week, "
-            f"{str(aver_meat)} on meat and {str(aver_extra)} on "
-            f"extra items.\nWhen there is enough data, I will tell "
+            f"\nOn average you spent {str(aver_total)} {curr} a week"
+            + (f", {join_words(spent)}" if spent else "") +
+            f".\nWhen there is enough data, I will tell "
             f"you how the reported month compares to the average of "
-            f"the three previous ones.\nStay tuned."
+            f"{_previous_months(window)}.\nStay tuned."
         )
 
-        print(msg_content)
+    by_category = dict(zip(categories, category_averages))
+    report = Report(
+        report_month, onemonth_before, twomonths_before, threemonths_before,
+        num_of_entries, total, aver_total, by_category.get("meat"), by_category.get("extra"),
+        msg_content, report_categories
+    )
+    _report_cache[cache_key] = report
+    if len(_report_cache) > REPORT_CACHE_SIZE:
+        _report_cache.popitem(last=False)
+    return report
+
+def unusual_month(data, averages, curr, categories=DEFAULT_CATEGORIES):
+    """A line about the values of a month's average that are unusual
+    for the household (see data["stats"]), or an empty string.
+    """
+    if "stats" not in data:
+        return ""
+    names = (
+        ["the average trip"]
+        + [f"{CATEGORY_DESCRIPTIONS.get(category, category)} a trip" for category in categories]
+        + ["the total"]
+    )
+    # older rows can be shorter than the categories, the total is always last
+    names = names[:len(averages) - 1] + names[-1:]
+    unusual = [
+        f"{names[column]} ({value} {curr}, usually about {mean} {curr})"
+        for column, value, mean in unusual_values(data["stats"]["months"], averages)
+        if column < len(names)
+    ]
+    return f"\nUnusual for you: {join_words(unusual)}." if unusual else ""
 
-def make_graph():
-    try:
+def _fit(values, length):
+    """'values' cut or padded with zeros to 'length'."""
+    return (list(values) + [0] * length)[:length]
 
-        month = [
-            threemonths_before, twomonths_before, onemonth_before, report_month
-        ]
+def _previous_months(count):
+    """'the previous month', 'the previous 3 months'..."""
+    return "the previous month" if count == 1 else f"the previous {count} months"
 
-        average_totals = [
-            data["average"][threemonths_before][0], 
-            data["average"][twomonths_before][0],
-            data["average"][onemonth_before][0], 
-            data["average"][report_month][0]
-        ]
+def _category_line(category, average, previous, curr, months):
+    """The line of the long report comparing one category with the
+    average of the 'months' months before.
+    """
+    if category == "extra":
+        return (
+            f"\nYou spent on average {str(average)} {curr} a week on extra items, "
+            f"{str(previous)} {curr} in the compared period."
+        )
+    return (
+        f"\n{category.capitalize()} expenses: "
+        f"{str(average)} {curr} last month "
+        f"and {str(previous)} {curr} in {_previous_months(months)}."
+    )
+
+class RollingWindow:
+    """Compares a month with the average of the 'window' months before it
+    (3, 6, 12...) using prefix sums of data["average"], so each comparison
+    costs the same however long the window is.
+    'gaps' says what to do with months missing from the window:
+    "strict" gives no comparison at all, "skip" averages the months
+    that are there (at least one is needed).
+    Only the months from 'first' to 'last' (month keys) are summed,
+    by default the whole history.
+    """
 
-        average_meat = [
-            data["average"][threemonths_before][1], 
-            data["average"][twomonths_before][1],
-            data["average"][onemonth_before][1], 
-            data["average"][report_month][1]
+    def __init__(self, data, window=3, gaps="strict", first=None, last=None):
+        if gaps not in ("strict", "skip"):
+            raise ValueError(f"gaps must be 'strict' or 'skip', not {gaps!r}")
+        if window < 1:
+            raise ValueError(f"window must be at least one month, not {window!r}")
+
+        averages = data["average"]
+        if first is None or last is None:
+            keys = [parse_month(month) for month in averages]
+            first, last = min(keys, default=0), max(keys, default=-1)
+
+        self.window = window
+        self.gaps = gaps
+        self.first = first
+
+        # sums[i] = [number of months, average total, average of every category]
+        # of the months from 'first' up to (not including) first + i,
+        # a category added later counts as 0 in the months before it
+        running = [0]
+        self.sums = [running]
+        for key in range(first, last + 1):
+            average = averages.get(month_name(key))
+            if average is not None:
+                running = [running[0] + 1] + [
+                    a + b for a, b in zip_longest(running[1:], average[:-1], fillvalue=0)
+                ]
+            self.sums.append(running)
+
+    def _bounds(self, key):
+        """The prefix sums before and at the end of the window before 'key'."""
+        last = len(self.sums) - 1
+        return (
+            self.sums[min(max(key - self.window - self.first, 0), last)],
+            self.sums[min(max(key - self.first, 0), last)]
+        )
+
+    def count(self, key):
+        """How many months of the window before the month 'key' have an average."""
+        lower, upper = self._bounds(key)
+        return upper[0] - lower[0]
+
+    def compare(self, key):
+        """[average total, meat, extra] (the average of every column) of the
+        window before the month 'key', or None if there are not enough months.
+        """
+        lower, upper = self._bounds(key)
+
+        count = upper[0] - lower[0]
+        if count == 0 or (self.gaps == "strict" and count < self.window):
+            return None
+        return [
+            round((a - b) / count) for a, b in zip_longest(upper[1:], lower[1:], fillvalue=0)
         ]
 
-        average_extra = [
-            data["average"][threemonths_before][2], 
-            data["average"][twomonths_before][2],
-            data["average"][onemonth_before][2], 
-            data["average"][report_month][2]
+def rolling_history(data, window=3, gaps="strict"):
+    """Comparison (see RollingWindow.compare) of every month in
+    data["average"] with the months before it, in one pass over the history.
+    """
+    rolling = RollingWindow(data, window, gaps)
+    return {
+        month_name(key): rolling.compare(key) for key in MonthIndex(data["average"])
+    }
+
+def find_tenants(root):
+    """Directories under 'root' (the root included) that hold both
+    settings.json and data.json, one per household, in sorted order.
+    """
+    tenants = []
+    for directory, _, files in os.walk(root):
+        if 'settings.json' in files and 'data.json' in files:
+            tenants.append(directory)
+    return sorted(tenants)
+
+def load_tenant(directory):
+    """One household's settings.json and data (see read_snapshot),
+    without touching the global ones.
+    """
+    with open(os.path.join(directory, 'settings.json')) as f:
+        tenant_settings = json.load(f)
+    tenant_data = read_snapshot(
+        os.path.join(directory, 'data.json'), os.path.join(directory, JOURNAL_FILE)
+    )
+    return tenant_settings, tenant_data
+
+def map_tenants(fn, tenants, workers=None):
+    """fn(tenant) for every one of 'tenants', in their order, in a pool of
+    'workers' processes (one per CPU by default, 1 means no pool at all).
+    """
+    if workers == 1:
+        return [fn(tenant) for tenant in tenants]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(fn, tenants, chunksize=max(1, len(tenants) // 64)))
+
+def tenant_report(directory, date):
+    """Load one household's files and make its report for the month
+    before 'date'. Returns None if nothing was bought that month.
+    Nothing is written back.
+    """
+    tenant_settings, tenant_data = load_tenant(directory)
+
+    try:
+        return compute_report(
+            tenant_settings["vegetarian?"], tenant_settings["currency"],
+            tenant_settings["goal"], tenant_data, date,
+            tenant_settings.get("window", 3), tenant_settings.get("gaps", "strict"),
+            tenant=directory, categories=categories_of(tenant_settings)
+        )
+    except KeyError:
+        return None
+
+def run_reports(root, date, workers=None):
+    """Make the reports of all households under 'root' in a pool of
+    'workers' processes (one per CPU by default, 1 means no pool at all).
+    Returns a list of (directory, Report or None) in the order of find_tenants.
+    """
+    tenants = find_tenants(root)
+    start = time.perf_counter()
+
+    reports = map_tenants(partial(tenant_report, date=date), tenants, workers)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"{len(tenants)} reports in {elapsed:.2f} s "
+        f"({len(tenants) / elapsed if elapsed else 0:.0f} reports/s)."
+    )
+    return list(zip(tenants, reports))
+
+def backfill_averages(data, date):
+    """Compute data["average"] of every month before the month of 'date'
+    that has entries, in one pass over data["weekly"] (reading the running
+    aggregates, so no month is scanned). Returns the months whose average
+    was missing or different, oldest first.
+    """
+    current = month_key(date)
+    changed = []
+
+    for month in data["weekly"]:
+        key = parse_month(month)
+        if key >= current or not data["weekly"][month]:
+            continue
+        average = month_summary(data, month)
+        if data["average"].get(month) != average:
+            data["average"][month] = average
+            changed.append((key, month))
+
+    return [month for _, month in sorted(changed)]
+
+def backfill_tenant(directory, date):
+    """Backfill one household's data.json, saved only if something changed."""
+    _, tenant_data = load_tenant(directory)
+
+    changed = backfill_averages(tenant_data, date)
+    if changed:
+        compact_journal(
+            os.path.join(directory, 'data.json'), os.path.join(directory, JOURNAL_FILE), tenant_data
+        )
+    return changed
+
+def backfill_tenants(root, date, workers=None):
+    """Backfill the averages of all households under 'root' in a pool of
+    'workers' processes (1 means no pool). Returns {directory: changed months}.
+    """
+    tenants = find_tenants(root)
+    changed = map_tenants(partial(backfill_tenant, date=date), tenants, workers)
+    return dict(zip(tenants, changed))
+
+def old_months(data, date, keep_months):
+    """Months of data["weekly"] before the last 'keep_months' months
+    (the month of 'date' included), oldest first.
+    """
+    if keep_months < 2:
+        raise ValueError("at least 2 months (this one and the reported one) have to be kept")
+    first_kept = month_key(date) - keep_months + 1
+    return [name for key, name in sorted(
+        (parse_month(month), month) for month in data["weekly"]
+    ) if key < first_kept]
+
+def archive_old_months(date, keep_months, json_file='data.json', journal_file=JOURNAL_FILE,
+                       archive_file=ARCHIVE_FILE):
+    """Move the entries of the months before the last 'keep_months'
+    months from the json file to the gzip archive. Their averages,
+    running aggregates, stats and rollup stay, so reports and charts
+    work the same; data["archived"] lists them. Their averages are
+    brought up to date first. Returns the archived months.
+    """
+    import gzip
+
+    with locked(journal_file):
+        snapshot = read_snapshot(json_file, journal_file)
+        months = old_months(snapshot, date, keep_months)
+        if not months:
+            return []
+
+        # entries added to an archived month are archived with the old ones
+        archived = set(snapshot.get("archived", ()))
+        stored = read_archive(archive_file) if archived.intersection(months) else {}
+        lines = "".join(
+            json.dumps({
+                "month": month, "entries": stored.get(month, []) + list(snapshot["weekly"][month])
+            }) + "\n"
+            for month in months
+        )
+        # every run adds a gzip member, gzip reads them as one stream
+        with gzip.open(archive_file, 'at') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+        for month in months:
+            if month in snapshot["running"]:
+                snapshot["average"][month] = month_summary(snapshot, month)
+            del snapshot["weekly"][month]
+            archived.add(month)
+        snapshot["archived"] = sorted(archived, key=parse_month)
+
+        write_snapshot(json_file, journal_file, snapshot)
+    return months
+
+def read_archive(archive_file=ARCHIVE_FILE):
+    """{month: entries} of the archive. A month archived more than once
+    (the json file wasn't saved after archiving) is taken from its last line.
+    """
+    import gzip
+
+    months = {}
+    try:
+        with gzip.open(archive_file, 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                months[record["month"]] = record["entries"]
+    except FileNotFoundError:
+        pass
+    return months
+
+def restore_months(months=None, json_file='data.json', journal_file=JOURNAL_FILE,
+                   archive_file=ARCHIVE_FILE):
+    """Put the archived entries of 'months' (all of them by default) back
+    into the json file, before any entries added to those months since,
+    and drop them from the archive. Returns the restored months.
+    """
+    import gzip
+
+    with locked(journal_file):
+        snapshot = read_snapshot(json_file, journal_file)
+        archived = snapshot.get("archived", [])
+        stored = read_archive(archive_file)
+        restored = [
+            month for month in (archived if months is None else months)
+            if month in archived and month in stored
         ]
+        if not restored:
+            return []
+
+        for month in restored:
+            snapshot["weekly"][month] = stored.pop(month) + list(snapshot["weekly"].get(month, ()))
+        snapshot["archived"] = [month for month in archived if month not in restored]
+
+        # the months in the json file again are left out of the new archive
+        kept = {month: entries for month, entries in stored.items() if month in snapshot["archived"]}
+        temporary = f"{archive_file}.{os.getpid()}.tmp"
+        with gzip.open(temporary, 'wt') as f:
+            for month, entries in kept.items():
+                f.write(json.dumps({"month": month, "entries": entries}) + "\n")
+        os.replace(temporary, archive_file)
+
+        write_snapshot(json_file, journal_file, snapshot)
+    return restored
+
+def tenant_stats(directory):
+    """One household's data["stats"] with the columns named after its
+    categories: {"trips": {"total": stat, "meat": stat...},
+    "months": {"total average": stat, "meat average": stat..., "total": stat}}.
+    """
+    tenant_settings, tenant_data = load_tenant(directory)
+    categories = categories_of(tenant_settings)
+    stats = tenant_data["stats"]
+
+    averages = [f"{name} average" for name in ("total",) + categories]
+    months = stats["months"]
+    return {
+        "trips": dict(zip(("total",) + categories, stats["trips"])),
+        "months": dict(zip(averages[:len(months) - 1] + ["total"], months)),
+    }
+
+def fleet_stats(root, workers=None):
+    """The stats of all households under 'root' merged column by column
+    (same name, same column), read in a pool of 'workers' processes
+    (1 means no pool). Same format as tenant_stats.
+    """
+    merged = {"trips": {}, "months": {}}
+    for stats in map_tenants(tenant_stats, find_tenants(root), workers):
+        for kind, columns in stats.items():
+            for name, stat in columns.items():
+                merged[kind][name] = merge_stats(merged[kind].get(name, new_stat()), stat)
+    return merged
+
+def graph_series(data, months):
+    """The lines of the graph for the given months: average totals,
+    the average of every category (meat and extra items by default)
+    and the totals, one lookup a month.
+    Raises KeyError if a month has no average.
+    """
+    return series_columns([data["average"][month] for month in months])
 
-        totals = [
-            data["average"][threemonths_before][3], 
-            data["average"][twomonths_before][3],
-            data["average"][onemonth_before][3], 
-            data["average"][report_month][3]
+def series_columns(rows):
+    """The lines of the graph out of data["average"]-like rows. Rows from
+    before a category was added get 0 for it, so every line is as long
+    as the others and the totals are always the last one.
+    """
+    width = max(map(len, rows), default=4)
+    rows = [_fit(row[:-1], width - 1) + row[-1:] for row in rows]
+    return [list(column) for column in zip(*rows)] or [[] for _ in range(width)]
+
+# Lines of the categories without a color of their own get one from matplotlib
+CATEGORY_COLORS = {"meat": "red", "extra": "yellow"}
+
+def plot_series(axes, months, series, categories=DEFAULT_CATEGORIES):
+    """Draw the graph_series lines on matplotlib axes."""
+    average_totals, *category_averages, totals = series
+    axes.plot(months, average_totals, color='green')
+    for category, averages in zip(categories, category_averages):
+        axes.plot(months, averages, color=CATEGORY_COLORS.get(category))
+    axes.plot(months, totals, color='black')
+
+def make_graph():
+    from matplotlib import pyplot as plt
+
+    try:
+
+        month = [
+            threemonths_before, twomonths_before, onemonth_before, report_month
         ]
 
-        plt.plot(month, average_totals, color='green')
-        plt.plot(month, average_meat, color='red')
-        plt.plot(month, average_extra, color='yellow')
-        plt.plot(month, totals, color='black')
-        plt.xlabel('average totals, meat, extra and total sums')
+        categories = categories_of(settings)
+        plot_series(plt, month, graph_series(data, month), categories)
+        plt.xlabel(f'average totals, {", ".join(categories)} and total sums')
         plt.ylabel(f'{settings["currency"]}')
         plt.title('Last 4 months')
         plt.show()
@@ -325,23 +1778,157 @@ def make_graph():
     except KeyError:
         print("When there are enough statistics, a graph will be shown for visualization")		
 
-def send_email(date):
-    if len(data["weekly"][date.strftime("%B %Y")]) == 1 and len(data["weekly"]) > 1:
-        msg = EmailMessage()
-        msg['Subject'] = "Shopping Report"
-        msg['From'] = EMAIL_ADDRESS
-        msg['To'] = EMAIL_ADDRESS
-        msg.set_content(msg_content)
-
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-            smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            smtp.send_message(msg)
-
-def save_to_json(json_file, updated_dict):
-    """Save the updated dictionary to the json file."""
-    with open(json_file, 'w') as f:
-        json.dump(updated_dict, f)				   
+def chart_path(data, date, curr, fmt="png", months=4, chart_dir=CHART_DIR,
+               categories=DEFAULT_CATEGORIES, level="month"):
+    """Where the chart of the 'months' months up to the reported one
+    (the month before 'date') is saved. The file name is a hash of
+    the series, the currency and the format, so a chart that would
+    look the same is never drawn twice.
+    With another 'level' (week, quarter, year) the chart shows that many
+    of those periods, read from the rollup.
+    Raises KeyError if a month has no average.
+    """
+    import hashlib
+
+    names = previous_periods(level, date, months)
+    series = period_series(data, level, names)
+
+    digest = hashlib.sha256(
+        json.dumps([names, series, curr, fmt, list(categories)]).encode()
+    ).hexdigest()[:32]
+    return os.path.join(chart_dir, f"{digest}.{fmt}"), names, series
+
+def render_graph(data, date, curr, fmt="png", months=4, chart_dir=CHART_DIR,
+                 categories=DEFAULT_CATEGORIES, level="month"):
+    """Draw the make_graph chart to a PNG or SVG file without showing
+    anything on the screen and return its path. Charts that are already
+    in 'chart_dir' are not drawn again.
+    Raises KeyError if a month has no average.
+    """
+    path, names, series = chart_path(data, date, curr, fmt, months, chart_dir, categories, level)
+    if os.path.exists(path):
+        return path
+
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    axes = figure.subplots()
+    plot_series(axes, names, series, categories)
+    axes.set_xlabel(f'average totals, {", ".join(categories)} and total sums')
+    axes.set_ylabel(curr)
+    axes.set_title(f'Last {months} {level}s')
+
+    os.makedirs(chart_dir, exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    figure.savefig(temporary, format=fmt)
+    os.replace(temporary, path)
+    return path
+
+def _render_job(job):
+    """render_graph for one tenant directory, in a worker process."""
+    directory, date, fmt, months, chart_dir = job
+    tenant_settings, tenant_data = load_tenant(directory)
+    try:
+        return render_graph(
+            tenant_data, date, tenant_settings["currency"], fmt, months, chart_dir,
+            categories_of(tenant_settings)
+        )
+    except KeyError:
+        return None
+
+def render_graphs(directories, dates, fmt="png", months=4, chart_dir=CHART_DIR, workers=None):
+    """Render the charts of every household directory for every date
+    in a pool of 'workers' processes (1 means no pool).
+    Returns {(directory, date): path or None}.
+    """
+    jobs = [(directory, date, fmt, months, chart_dir) for directory in directories for date in dates]
+    paths = map_tenants(_render_job, jobs, workers)
+    return {(job[0], job[1]): path for job, path in zip(jobs, paths)}
+
+def make_email(content, to=None, chart=None):
+    """The report email, sent from and by default to EMAIL_ADDRESS,
+    with the chart file attached if there is one.
+    """
+    from email.message import EmailMessage
+
+    msg = EmailMessage()
+    msg['Subject'] = "Shopping Report"
+    msg['From'] = EMAIL_ADDRESS
+    msg['To'] = to or EMAIL_ADDRESS
+    msg.set_content(content)
+
+    if chart is not None:
+        with open(chart, 'rb') as f:
+            subtype = "svg+xml" if chart.endswith(".svg") else "png"
+            msg.add_attachment(
+                f.read(), maintype="image", subtype=subtype, filename=os.path.basename(chart)
+            )
+    return msg
+
+def send_email(date, chart=None):
+    if len(data["weekly"][month_name(month_key(date))]) == 1 and len(data["weekly"]) > 1:
+        email_reports([make_email(msg_content, chart=chart)])
+
+def email_reports(messages, **options):
+    """Send the messages with mailer (retried, and kept in its outbox
+    if they still fail) and say what couldn't be sent.
+    """
+    import mailer
+
+    sent, failed = mailer.send_messages(messages, **options)
+    if failed:
+        print(f"{len(failed)} of {len(messages)} emails couldn't be sent, they are in "
+              f"{os.path.dirname(failed[0])} (send them later with the resend command).")
+    return sent, failed
+
+def save_to_json(json_file, updated_dict, binary=None):
+    """Save the updated dictionary to the json file.
+    It is written to a temporary file first which then replaces the old one,
+    so the json file is never left half-written.
+    Unless 'binary' says otherwise, files ending with .ssk and files that
+    are already binary snapshots are written in the binary format
+    (see binary_snapshot).
+    """
+    temporary = f"{json_file}.{os.getpid()}.tmp"
+    try:
+        if binary is None:
+            binary = is_binary_file(json_file)
+
+        if binary:
+            import binary_snapshot
+            content = binary_snapshot.dumps(updated_dict)
+        else:
+            content = json.dumps(updated_dict, default=_to_json).encode()
+
+        with open(temporary, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, json_file)
+
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise				   
 				   
+def is_binary_file(json_file):
+    """Should the file be saved as a binary snapshot?"""
+    if json_file.endswith(".ssk"):
+        return True
+    try:
+        with open(json_file, 'rb') as f:
+            return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    except FileNotFoundError:
+        return False
+
+def convert_snapshot(json_file, binary=True):
+    """Rewrite the file in the binary format (or back in json),
+    the following saves keep the format.
+    """
+    with open(json_file, 'rb') as f:
+        snapshot = parse_snapshot(f.read())
+    save_to_json(json_file, snapshot, binary)
+
 def change_goal(json_file, settings):
     """Each time the program is run, 
     the user will have a chance to change their set goal. 
@@ -366,8 +1953,8 @@ def change_goal(json_file, settings):
                 else:
                     print("Oops! I need a number, try again")
 
-            with open(json_file, 'w') as f:
-                json.dump(settings, f)
+            save_to_json(json_file, settings)
+            forget_reports()
 
             break
 
@@ -377,6 +1964,264 @@ def change_goal(json_file, settings):
         else:
             print("Oops, something went wrong. Try again with 'yes' or 'no'")
 
-if __name__ == '__main__':
-    main()
+def cli(argv=None):
+    """Command line without questions, for scripts and cron:
+
+        ShoppingStatsKeeper.py add --total 120 --meat 20 --extra 15
+        ShoppingStatsKeeper.py add --total 120 --amount dairy=20 --amount produce=35
+        ShoppingStatsKeeper.py report [--email] [--period quarter]
+        ShoppingStatsKeeper.py set-goal 900
+        ShoppingStatsKeeper.py import receipts.csv
+        ShoppingStatsKeeper.py reports households/ [--workers 8] [--email]
+        ShoppingStatsKeeper.py resend [--outbox outbox]
+        ShoppingStatsKeeper.py backfill [households/] [--workers 8]
+        ShoppingStatsKeeper.py percentiles [households/] [--quantiles 0.5 0.9]
+
+    Without a command the usual interactive program runs.
+    --profile (before the command) prints the timing of every stage.
+    """
+    import argparse
+
+    global PROFILE
+
+    def category_amount(value):
+        category, equals, amount = value.partition("=")
+        if not equals:
+            raise argparse.ArgumentTypeError(f"{value!r} isn't CATEGORY=AMOUNT")
+        return category, amount
+
+    parser = argparse.ArgumentParser(prog="ShoppingStatsKeeper.py")
+    parser.add_argument("--profile", action="store_true", help="print the timing of every stage")
+    commands = parser.add_subparsers(dest="command")
+
+    add = commands.add_parser("add", help="add one shopping trip")
+    add.add_argument("--total", required=True)
+    add.add_argument("--meat", help="0 by default")
+    add.add_argument("--extra")
+    add.add_argument("--amount", action="append", default=[], metavar="CATEGORY=AMOUNT",
+                     type=category_amount,
+                     help="the amount of one of the \"categories\" in settings.json")
+    add.add_argument("--date", type=datetime.date.fromisoformat, default=today,
+                     help="YYYY-MM-DD, today by default")
+
+    report = commands.add_parser("report", help="make the report of the previous month")
+    report.add_argument("--date", type=datetime.date.fromisoformat, default=today,
+                        help="a day in the month after the reported one")
+    report.add_argument("--email", action="store_true", help="also send it by email")
+    report.add_argument("--chart", choices=["png", "svg"],
+                        help="also draw a chart of the last months (attached to the email)")
+    report.add_argument("--period", choices=["week", "month", "quarter", "year"], default="month",
+                        help="compare the last week, quarter or year instead of the last month")
+
+    set_goal = commands.add_parser("set-goal", help="change the monthly goal")
+    set_goal.add_argument("goal")
+
+    bulk = commands.add_parser("import", help="import a CSV or JSON-lines file")
+    bulk.add_argument("path")
+
+    backfill = commands.add_parser(
+        "backfill", help="compute the missing or outdated averages of all finished months"
+    )
+    backfill.add_argument("root", nargs="?", default=".",
+                          help="directory with one or many households")
+    backfill.add_argument("--workers", type=int)
+
+    percentiles = commands.add_parser(
+        "percentiles", help="percentiles of the trips and months of all households"
+    )
+    percentiles.add_argument("root", nargs="?", default=".",
+                             help="directory with one or many households")
+    percentiles.add_argument("--quantiles", type=float, nargs="+", default=[0.5, 0.9, 0.99])
+    percentiles.add_argument("--workers", type=int)
+
+    archive = commands.add_parser(
+        "archive", help=f"move the entries of old months to {ARCHIVE_FILE}, keeping their averages"
+    )
+    archive.add_argument("--keep-months", type=int,
+                         help="months kept in data.json, this one included (\"keep_months\" by default)")
+    archive.add_argument("--date", type=datetime.date.fromisoformat, default=today,
+                         help="a day in the month counted as this one")
+
+    restore = commands.add_parser("restore", help=f"move archived entries back from {ARCHIVE_FILE}")
+    restore.add_argument("months", nargs="*", metavar="MONTH", help='e.g. "April 2019", all by default')
+
+    reports = commands.add_parser("reports", help="make the reports of many households")
+    reports.add_argument("root")
+    reports.add_argument("--workers", type=int)
+    reports.add_argument("--email", action="store_true",
+                         help="also send every report to the \"email\" in its settings.json")
+
+    resend = commands.add_parser("resend", help="send the emails that failed before again")
+    resend.add_argument("--outbox", default="outbox")
+
+    args = parser.parse_args(argv)
+    if args.profile:
+        PROFILE = "print"
+
+    if args.command is None:
+        main()
+        return
+
+    if args.command == "reports":
+        tenant_reports = run_reports(args.root, today, args.workers)
+        for directory, tenant_report in tenant_reports:
+            if tenant_report is not None:
+                print(f"{directory}:\n{tenant_report.msg_content}\n")
+        if args.email:
+            import mailer
+            with stage("send_email"):
+                sent, failed = mailer.send_reports(tenant_reports)
+            print(f"{sent} reports sent" + (f", {len(failed)} kept in the outbox" if failed else ""))
+        return
+
+    if args.command == "resend":
+        import mailer
+        print(f"{mailer.resend_outbox(args.outbox)} emails sent")
+        return
+
+    if args.command == "backfill":
+        for directory, changed in backfill_tenants(args.root, today, args.workers).items():
+            if changed:
+                print(f"{directory}: {', '.join(changed)}")
+        return
+
+    if args.command == "percentiles":
+        print(f"{'':<24}{'count':>8}{'mean':>10}" + "".join(f"{f'p{q * 100:g}':>10}" for q in args.quantiles))
+        for kind, columns in fleet_stats(args.root, args.workers).items():
+            for name, stat in columns.items():
+                if stat["count"]:
+                    print(
+                        f"{kind + ' ' + name:<24}{stat['count']:>8}{stat['mean']:>10.0f}"
+                        + "".join(f"{quantile(stat, q):>10}" for q in args.quantiles)
+                    )
+        return
+
+    if not os.path.exists('settings.json'):
+        parser.error("there is no settings.json yet, run the program once without a command")
+    with stage("load_settings", read=['settings.json']):
+        load_settings('settings.json')
+
+    if args.command == "add":
+        try:
+            categories = categories_of(settings)
+            amounts = dict(args.amount)
+            if args.meat is not None:
+                amounts["meat"] = args.meat
+            elif "meat" in categories:
+                amounts.setdefault("meat", "0")
+            if args.extra is not None:
+                amounts["extra"] = args.extra
+            entry = parse_amounts(args.total, amounts, settings["vegetarian?"], categories)
+        except ValueError as e:
+            parser.error(str(e))
+        add_entry(args.date, entry)
+
+    elif args.command == "report":
+        if args.period != "month" and settings.get("storage", "json") != "json":
+            parser.error(f'--period isn\'t supported with "storage": "{settings["storage"]}"')
+        with stage("load_json", read=['data.json', JOURNAL_FILE, 'data.db']):
+            load_report_data(args.date)
+
+        content = None
+        if args.period != "month":
+            # read from the rollup, nothing is stored
+            with stage("do_statistics"):
+                content = period_report(
+                    data, args.period, args.date, settings["currency"], categories_of(settings)
+                )
+            if content is not None:
+                print(content)
+        elif data["weekly"].get(month_name(month_key(args.date) - 1)):
+            with stage("do_statistics"):
+                report = do_statistics(
+                    settings["vegetarian?"], settings["currency"],
+                    settings["goal"], data, args.date,
+                    settings.get("window", 3), settings.get("gaps", "strict"),
+                    categories_of(settings)
+                )
+                content = report.msg_content
+            with stage("save_to_json", written=['data.json', 'data.db']):
+                save_report_data(report)
+
+        if content is None:
+            print(f"Nothing was bought last {args.period}, there is nothing to report.")
+        else:
+            chart = None
+            if args.chart:
+                with stage("make_graph"):
+                    try:
+                        chart = render_graph(
+                            data, args.date, settings["currency"], args.chart,
+                            categories=categories_of(settings), level=args.period
+                        )
+                        print(f"The chart is in {chart}")
+                    except KeyError:
+                        print("When there are enough statistics, a chart will be drawn too.")
+            if args.email:
+                with stage("send_email"):
+                    email_reports([make_email(content, chart=chart)])
+
+    elif args.command == "set-goal":
+        if not args.goal.isdigit():
+            parser.error("the goal must be a whole number")
+        settings["goal"] = args.goal
+        with stage("change_goal", written=['settings.json']):
+            save_to_json('settings.json', settings)
+        forget_reports()
+
+    elif args.command == "import":
+        if settings.get("storage", "json") != "json":
+            parser.error(f'import isn\'t supported with "storage": "{settings["storage"]}"')
+        bulk_import(args.path, settings["vegetarian?"], categories=categories_of(settings))
+
+    elif args.command in ("archive", "restore"):
+        if settings.get("storage", "json") != "json":
+            parser.error(f'archiving isn\'t supported with "storage": "{settings["storage"]}"')
+
+        if args.command == "archive":
+            try:
+                keep_months = args.keep_months or keep_months_of(settings)
+            except ValueError as e:
+                parser.error(str(e))
+            if keep_months is None:
+                parser.error('give --keep-months or set "keep_months" in settings.json')
+            try:
+                with stage("archive", written=['data.json', ARCHIVE_FILE]):
+                    months = archive_old_months(args.date, keep_months)
+            except ValueError as e:
+                parser.error(str(e))
+        else:
+            with stage("restore", written=['data.json', ARCHIVE_FILE]):
+                months = restore_months(args.months or None)
+
+        print(f"{args.command.capitalize()}d: {', '.join(months)}." if months else "Nothing to do.")
 
+    report_metrics()
+
+def add_entry(date, entry):
+    """Save one entry without loading the history: it is only appended
+    to the journal (or data.db, or the month's shard, depending on the
+    "storage" setting). The journal is folded into data.json when it gets big.
+    """
+    storage = settings.get("storage")
+
+    if storage == "sqlite":
+        import sqlite_storage
+        with stage("save_new_entry", written=['data.db']):
+            conn = sqlite_storage.connect('data.db')
+            sqlite_storage.save_entry(conn, date, entry)
+            conn.close()
+
+    elif storage == "shards":
+        with stage("save_new_entry", written=[shard_file(SHARD_DIR, month_key(date))]):
+            add_to_shard(SHARD_DIR, date, entry)
+
+    else:
+        with stage("save_new_entry", written=[JOURNAL_FILE]):
+            append_to_journal(JOURNAL_FILE, date, entry)
+        if os.path.getsize(JOURNAL_FILE) > JOURNAL_MAX_BYTES:
+            with stage("save_to_json", written=['data.json']):
+                compact_journal('data.json', JOURNAL_FILE)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,230 @@
+"""Benchmarks of the load / add entry / report / save pipeline.
+
+Synthetic histories of different lengths are generated and every stage
+is timed on its own (the best of a few repeats). The results are written
+as JSON and can be compared with a baseline saved earlier, e.g.
+
+    python benchmarks.py --save-baseline bench_baseline.json
+    python benchmarks.py --baseline bench_baseline.json
+
+exits with 1 when a stage got slower than the tolerance allows.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import ShoppingStatsKeeper as ssk
+
+def make_history(years, trips, today, seed=0):
+    """A dictionary in the load_json format with 'years' of history before
+    the month of 'today', around 'trips' entries a month, and averages
+    for every finished month.
+    """
+    rng = random.Random(seed)
+    data = {"weekly": {}, "average": {}}
+    current = ssk.month_key(today)
+
+    for key in range(current - years * 12, current):
+        entries = []
+        for _ in range(max(1, trips + rng.randint(-trips // 4, trips // 4))):
+            total = rng.randint(20, 400)
+            meat = rng.randint(0, total // 4)
+            entries.append([total, meat, rng.randint(0, total // 4)])
+        data["weekly"][ssk.month_name(key)] = entries
+
+    data["average"] = ssk.monthly_averages(data, data["weekly"])
+    return data
+
+def best_time(function, repeat):
+    """The shortest of 'repeat' runs of function(), in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_history(directory, years, trips, repeat):
+    """Time every stage on one generated history. Returns
+    {stage: seconds}.
+    """
+    today = datetime.date(2000 + years, 1, 5)
+    json_file = os.path.join(directory, 'data.json')
+    binary_file = os.path.join(directory, 'data.ssk')
+    journal_file = os.path.join(directory, ssk.JOURNAL_FILE)
+    ssk.save_to_json(json_file, make_history(years, trips, today))
+    # saved again with the aggregates and stats load_json builds the first time
+    data = ssk.load_json(json_file, journal_file)
+    ssk.save_to_json(json_file, data)
+    ssk.save_to_json(binary_file, data)
+
+    report_key = ssk.month_key(today) - 1
+    months = [ssk.month_name(key) for key in range(report_key - 3, report_key + 1)]
+
+    return {
+        "load_json": best_time(lambda: ssk.load_json(json_file, journal_file), repeat),
+        "save_new_entry": best_time(
+            lambda: ssk.save_new_entry(today, data, [100, 20, 10]), repeat
+        ),
+        # the cache is emptied every time, so the report is really computed
+        "do_statistics": best_time(
+            lambda: (ssk.forget_reports(), ssk.compute_report("no", "PLN", "500", data, today)), repeat
+        ),
+        "cached_report": best_time(
+            lambda: ssk.compute_report("no", "PLN", "500", data, today), repeat
+        ),
+        "graph_series": best_time(lambda: ssk.graph_series(data, months), repeat),
+        "save_to_json": best_time(lambda: ssk.save_to_json(json_file, data), repeat),
+        "load_binary": best_time(lambda: ssk.load_json(binary_file, journal_file), repeat),
+        "save_binary": best_time(lambda: ssk.save_to_json(binary_file, data), repeat),
+    }
+
+def bench_tenants(directory, tenants, years, trips):
+    """Time the reports of 'tenants' households made one after another.
+    Returns {stage: seconds}.
+    """
+    today = datetime.date(2000 + years, 1, 5)
+    settings = {"currency": "PLN", "vegetarian?": "no", "goal": "800"}
+
+    for number in range(tenants):
+        tenant_dir = os.path.join(directory, f"tenant{number:05d}")
+        os.mkdir(tenant_dir)
+        ssk.save_to_json(os.path.join(tenant_dir, 'settings.json'), settings)
+        ssk.save_to_json(
+            os.path.join(tenant_dir, 'data.json'), make_history(years, trips, today, number)
+        )
+
+    start = time.perf_counter()
+    ssk.run_reports(directory, today, workers=1)
+    return {"run_reports": time.perf_counter() - start}
+
+def bench_startup(directory, repeat):
+    """Time adding one entry from the command line, interpreter start included.
+    Returns {stage: seconds}.
+    """
+    ssk.save_to_json(
+        os.path.join(directory, 'settings.json'),
+        {"currency": "PLN", "vegetarian?": "no", "goal": "800"}
+    )
+    command = [
+        sys.executable, os.path.abspath(ssk.__file__),
+        "add", "--total", "120", "--meat", "20", "--extra", "15"
+    ]
+    return {
+        "cli_add": best_time(lambda: subprocess.run(command, cwd=directory, check=True), repeat)
+    }
+
+def run(years=(1, 10, 50), trips=(4, 12), tenants=20, repeat=5):
+    """Run all benchmarks and return the results as a JSON-ready dictionary."""
+    results = []
+
+    for length in years:
+        for count in trips:
+            with tempfile.TemporaryDirectory() as directory:
+                timings = bench_history(directory, length, count, repeat)
+            for stage, seconds in timings.items():
+                results.append(
+                    {"stage": stage, "years": length, "trips": count, "seconds": seconds}
+                )
+
+    with tempfile.TemporaryDirectory() as directory:
+        for stage, seconds in bench_startup(directory, repeat).items():
+            results.append({"stage": stage, "years": 0, "trips": 0, "seconds": seconds})
+
+    if tenants:
+        with tempfile.TemporaryDirectory() as directory:
+            timings = bench_tenants(directory, tenants, min(years), min(trips))
+        for stage, seconds in timings.items():
+            results.append({
+                "stage": stage, "years": min(years), "trips": min(trips),
+                "tenants": tenants, "seconds": seconds
+            })
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+def binary_gains(results):
+    """How much faster the binary snapshot loads than data.json, as
+    (years, trips, load_json seconds, load_binary seconds) tuples.
+    """
+    times = {
+        (result["stage"], result["years"], result["trips"]): result["seconds"]
+        for result in results["results"]
+    }
+    return [
+        (years, trips, seconds, times[("load_binary", years, trips)])
+        for (stage, years, trips), seconds in times.items()
+        if stage == "load_json" and ("load_binary", years, trips) in times
+    ]
+
+def _result_key(result):
+    return (result["stage"], result["years"], result["trips"], result.get("tenants"))
+
+def compare(results, baseline, tolerance=0.25):
+    """Stages that got slower than the baseline by more than 'tolerance'
+    (0.25 = 25%), as a list of (stage description, baseline, now) tuples.
+    """
+    before = {_result_key(result): result["seconds"] for result in baseline["results"]}
+    regressions = []
+
+    for result in results["results"]:
+        key = _result_key(result)
+        if key in before and result["seconds"] > before[key] * (1 + tolerance):
+            description = f"{result['stage']} ({result['years']} years, {result['trips']} trips"
+            if result.get("tenants"):
+                description += f", {result['tenants']} tenants"
+            regressions.append((description + ")", before[key], result["seconds"]))
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--trips", type=int, nargs="+", default=[4, 12],
+                        help="shopping trips a month")
+    parser.add_argument("--tenants", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--baseline", help="compare with this earlier output")
+    parser.add_argument("--save-baseline", metavar="FILE", help="also save the output here")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = run(args.years, args.trips, args.tenants, args.repeat)
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    for result in results["results"]:
+        print(
+            f"{result['stage']:>15} {result['years']:>3} years {result['trips']:>3} trips "
+            f"{result['seconds'] * 1000:>10.3f} ms"
+        )
+    for years, trips, json_seconds, binary_seconds in binary_gains(results):
+        print(
+            f"Binary snapshot, {years} years {trips} trips: loads "
+            f"{json_seconds / binary_seconds:.1f}x as fast as data.json"
+        )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for description, before, now in regressions:
+            print(f"Slower: {description} {before * 1000:.3f} ms -> {now * 1000:.3f} ms")
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""Binary snapshot format, an optional replacement for the data.json text.
+
+Layout (all little-endian):
+
+    header        magic b"SSKB", version (H), values in an entry (H, the
+                  total and the categories, 0 means the 3 of
+                  [total, meat, extra]), number of months (I)
+    weekly flags  one byte per month, 1 if the month is in "weekly"
+                  (it may only have an average), padded to 8 bytes
+    month index   one record per month, sorted by month key:
+                  month key (i), first entry (I), number of entries (I),
+                  has an average (?), has running aggregates (?),
+                  2 padding bytes, average (one value per value in an
+                  entry and the month's total), running aggregates (the
+                  number of entries and the sum of every value)
+    entries       month after month, each month column by column: the
+                  totals of all its entries, then the meat amounts, ...
+    extra         the other keys of the dictionary (e.g. "stats") as json,
+                  only if there are any
+
+Values are 4-byte integers (version 2), or 8-byte ones (version 3) when
+some value doesn't fit in 4 bytes. Version 1 files (8-byte values, entry
+after entry, no running aggregates in the index, those of archived
+months in the extra json) can still be read.
+
+The columns of a month can be read straight out of the file buffer with
+month_columns, without copying or parsing anything; loads copies all
+entries into one array and slices it into ShoppingStatsKeeper.MonthColumns,
+and takes "running" from the index, so nothing is summed again. Every entry is stored with
+the same number of values: entries and averages from before a category
+was added get 0 for it.
+"""
+from array import array
+import json
+import struct
+import sys
+import ShoppingStatsKeeper
+
+MAGIC = b"SSKB"
+VERSION = 2
+WIDE_VERSION = 3
+SUFFIX = ".ssk"
+
+# version: (array type code of a value, stored column by column)
+FORMATS = {1: ("q", False), 2: ("i", True), 3: ("q", True)}
+
+HEADER = struct.Struct("<4sHHI")
+DEFAULT_WIDTH = 3
+
+def index_struct(width, version=VERSION):
+    """The month index record of entries with 'width' values."""
+    typecode, _ = FORMATS[version]
+    if version == 1:
+        return struct.Struct(f"<iII?3x{width + 1}q")
+    return struct.Struct(f"<iII??2x{width + 1}{typecode}{width + 1}{typecode}")
+
+def is_binary(buf):
+    return bytes(buf[:len(MAGIC)]) == MAGIC
+
+def dumps(data):
+    """The 'weekly' and 'average' parts of the dictionary as bytes."""
+    try:
+        return _dumps(data, VERSION)
+    except (OverflowError, struct.error):
+        return _dumps(data, WIDE_VERSION)
+
+def _dumps(data, version):
+    typecode, _ = FORMATS[version]
+    weekly = data["weekly"]
+    average = data["average"]
+    months = sorted(
+        (ShoppingStatsKeeper.parse_month(month), month)
+        for month in weekly.keys() | average.keys()
+    )
+
+    widths = set()
+    for entries in weekly.values():
+        if isinstance(entries, ShoppingStatsKeeper.MonthColumns):
+            widths.update([len(entries.columns)] if len(entries) else [])
+        else:
+            widths.update(len(entry) for entry in entries)
+    widths.update(len(row) - 1 for row in average.values())
+    width = max(widths, default=DEFAULT_WIDTH)
+    index_record = index_struct(width, version)
+    running = data.get("running", {})
+    # the total is the last value of an average row
+    fit = ShoppingStatsKeeper._fit
+
+    index = bytearray()
+    entries = array(typecode)
+    first = 0
+    for key, month in months:
+        month_entries = weekly.get(month)
+        month_average = average.get(month)
+        month_running = running.get(month)
+        count = len(month_entries) if month_entries is not None else 0
+
+        if month_average is not None and len(month_average) != width + 1:
+            month_average = fit(month_average[:-1], width) + month_average[-1:]
+        if month_running is not None and len(month_running) != width + 1:
+            month_running = fit(month_running, width + 1)
+        index += index_record.pack(
+            key, first, count, month_average is not None, month_running is not None,
+            *(month_average or [0] * (width + 1)), *(month_running or [0] * (width + 1))
+        )
+        if count:
+            for column in _columns(month_entries, width):
+                if isinstance(column, array) and column.typecode == typecode:
+                    entries.extend(column)
+                else:
+                    entries.fromlist(list(column))
+        first += count
+
+    if sys.byteorder != "little":
+        entries.byteswap()
+
+    extra = {key: value for key, value in data.items() if key not in ("weekly", "average", "running")}
+
+    return b"".join((
+        HEADER.pack(MAGIC, version, width, len(months)),
+        _weekly_flags(months, weekly),
+        bytes(index),
+        entries.tobytes(),
+        json.dumps(extra).encode() if extra else b"",
+    ))
+
+def _columns(entries, width):
+    """The columns of a month's entries, padded with zero columns to 'width'."""
+    if isinstance(entries, ShoppingStatsKeeper.MonthColumns):
+        columns = list(entries.columns)
+    else:
+        columns = ShoppingStatsKeeper._transpose(entries)
+    return columns + [[0] * len(entries)] * (width - len(columns))
+
+def _weekly_flags(months, weekly):
+    """One byte per month saying whether it is in data["weekly"],
+    padded to 8 bytes.
+    """
+    flags = bytes(month in weekly for _, month in months)
+    return flags + bytes(-len(flags) % 8)
+
+def read_index(buf):
+    """[(month key, first entry, number of entries, in weekly, average or None,
+    running aggregates or None)], the offset of the entries in 'buf', the
+    number of values in an entry and the version of the format.
+    """
+    magic, version, width, count = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("not a binary snapshot")
+    if version not in FORMATS:
+        raise ValueError(f"unsupported binary snapshot version {version}")
+    width = width or DEFAULT_WIDTH
+    index_record = index_struct(width, version)
+
+    flags_offset = HEADER.size
+    index_offset = flags_offset + count + (-count % 8)
+    entries_offset = index_offset + count * index_record.size
+
+    index = []
+    for i, (key, first, entries, has_average, *values) in enumerate(
+        index_record.iter_unpack(memoryview(buf)[index_offset:entries_offset])
+    ):
+        if version == 1:
+            has_running, average, running = False, values, None
+        else:
+            has_running, average, running = values[0], values[1:width + 2], values[width + 2:]
+        index.append((
+            key, first, entries, bool(buf[flags_offset + i]),
+            average if has_average else None, running if has_running else None
+        ))
+    return index, entries_offset, width, version
+
+def month_columns(buf, first, count, entries_offset, width=DEFAULT_WIDTH, version=VERSION):
+    """The columns of one month (totals, meat, extra...) as memoryviews
+    of little-endian integers into 'buf', nothing is copied.
+    """
+    typecode, by_column = FORMATS[version]
+    size = array(typecode).itemsize
+    start = entries_offset + first * width * size
+    view = memoryview(buf)[start:start + count * width * size].cast("B")
+    if by_column:
+        return tuple(view[i * count * size:(i + 1) * count * size] for i in range(width))
+    # version 1: entry after entry
+    values = view.cast(typecode)
+    return tuple(memoryview(array(typecode, values[i::width])).cast("B") for i in range(width))
+
+def loads(buf):
+    """The dictionary stored in 'buf'. Months of "weekly" are MonthColumns."""
+    index, entries_offset, width, version = read_index(buf)
+    typecode, by_column = FORMATS[version]
+    data = {"weekly": {}, "average": {}}
+    weekly, averages, running = data["weekly"], data["average"], {}
+
+    values = array(typecode)
+    extra_offset = entries_offset + sum(record[2] for record in index) * width * values.itemsize
+    values.frombytes(memoryview(buf)[entries_offset:extra_offset])
+    if sys.byteorder != "little":
+        values.byteswap()
+    if len(buf) > extra_offset:
+        data.update(json.loads(bytes(memoryview(buf)[extra_offset:])))
+
+    from_columns = ShoppingStatsKeeper.MonthColumns.from_columns
+    month_name = ShoppingStatsKeeper.month_name
+    for key, first, count, in_weekly, average, month_running in index:
+        month = month_name(key)
+        if in_weekly:
+            start = first * width
+            if by_column:
+                weekly[month] = from_columns([
+                    values[start + i * count:start + (i + 1) * count] for i in range(width)
+                ])
+            else:
+                weekly[month] = from_columns([
+                    values[start + i:start + count * width:width] for i in range(width)
+                ])
+        if average is not None:
+            averages[month] = average
+        if month_running is not None:
+            running[month] = month_running
+
+    if running:
+        data["running"] = running
+    elif "running" in data:
+        # version 1 only stored the archived months, the others are added
+        ShoppingStatsKeeper.rebuild_aggregates(data)
+    return data
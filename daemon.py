@@ -0,0 +1,348 @@
+"""A long-running process keeping the households in memory, for scripts
+adding many entries or asking for many reports.
+
+Every command of the usual program starts a new interpreter and reads
+settings.json and data.json again. The daemon loads a household the
+first time it's asked about it and keeps it, answering requests on a
+Unix socket, one line per request and one line per reply:
+
+    ADD <household> <total> <meat> <extra> [YYYY-MM-DD]  -> OK
+    REPORT <household> [YYYY-MM-DD]                       -> OK <report as json>
+    GOAL <household> <goal>                               -> OK
+    FLUSH                                                 -> OK <number of saved entries>
+    PING                                                  -> OK
+    STOP                                                  -> OK, then it saves everything and exits
+
+<household> is the directory of its settings.json and data.json relative
+to the daemon's root ("." for the root itself). ADD takes one amount for
+each of the household's categories, in their order (meat and extra
+unless settings.json has its own "categories"). REPORT answers "OK null"
+when nothing was bought in the reported month. Errors are answered with
+"ERR <message>".
+
+New entries are kept in memory and appended to the households' journals
+in batches, every FLUSH_INTERVAL seconds or after FLUSH_ENTRIES entries,
+whichever comes first, so an entry already answered with OK is lost if
+the daemon is killed before the next flush. Averages stored by reports
+and changed goals are written by the same flushes. The daemon expects
+to be the only program changing the households' files while it runs.
+
+    python daemon.py [root] [--socket ssk.sock]
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import ShoppingStatsKeeper
+
+SOCKET = 'ssk.sock'
+FLUSH_INTERVAL = 1.0
+FLUSH_ENTRIES = 256
+# the optional last argument of ADD, anything else is an amount (also a negative one)
+DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+class Tenant:
+    """One household's settings and data and the changes not saved yet."""
+
+    def __init__(self, directory):
+        self.settings_file = os.path.join(directory, 'settings.json')
+        self.json_file = os.path.join(directory, 'data.json')
+        self.journal_file = os.path.join(directory, ShoppingStatsKeeper.JOURNAL_FILE)
+
+        with open(self.settings_file) as f:
+            self.settings = json.load(f)
+        if self.settings.get("storage", "json") != "json":
+            raise ValueError(f'"storage": "{self.settings["storage"]}" is not supported by the daemon')
+        self.categories = ShoppingStatsKeeper.categories_of(self.settings)
+        self.data = ShoppingStatsKeeper.read_snapshot(self.json_file, self.journal_file)
+
+        self.pending = []
+        self.averages_changed = False
+        self.settings_changed = False
+
+    def flush(self):
+        """Save the changes, returns the number of saved entries."""
+        saved = len(self.pending)
+        if self.pending:
+            ShoppingStatsKeeper.append_entries_to_journal(self.journal_file, self.pending)
+            self.pending = []
+
+        if self.averages_changed or (
+            saved and os.path.getsize(self.journal_file) > ShoppingStatsKeeper.JOURNAL_MAX_BYTES
+        ):
+            ShoppingStatsKeeper.compact_journal(self.json_file, self.journal_file, self.data)
+            self.averages_changed = False
+
+        if self.settings_changed:
+            ShoppingStatsKeeper.save_to_json(self.settings_file, self.settings)
+            self.settings_changed = False
+
+        return saved
+
+class Daemon:
+    """The households under 'root' and the requests about them (see handle).
+    One request is handled at a time, the flushes run in their own thread.
+    """
+
+    def __init__(self, root='.', flush_interval=FLUSH_INTERVAL, flush_entries=FLUSH_ENTRIES):
+        self.root = os.path.abspath(root)
+        self.flush_interval = flush_interval
+        self.flush_entries = flush_entries
+        self.tenants = {}
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        # command: (method, least and most arguments (None for any), their description)
+        self.commands = {
+            "ADD": (self.add, 2, None, "<household> <total> <amount of every category...> [YYYY-MM-DD]"),
+            "REPORT": (self.report, 1, 2, "<household> [YYYY-MM-DD]"),
+            "GOAL": (self.goal, 2, 2, "<household> <goal>"),
+            "FLUSH": (self.flush, 0, 0, ""),
+            "PING": (self.ping, 0, 0, ""),
+            "STOP": (self.stop, 0, 0, ""),
+        }
+
+    def handle(self, line):
+        """The reply to one request line, without the newline."""
+        words = line.split()
+        if not words:
+            return "ERR empty request"
+
+        name = words[0].upper()
+        if name not in self.commands:
+            return f"ERR unknown command {words[0]}"
+        command, least, most, usage = self.commands[name]
+        if len(words) - 1 < least or (most is not None and len(words) - 1 > most):
+            return f"ERR usage: {name} {usage}".rstrip()
+
+        try:
+            with self.lock:
+                reply = command(*words[1:])
+        except Exception as e:
+            # whatever went wrong with one request, the thread keeps serving
+            return f"ERR {e}"
+        return "OK" if reply is None else f"OK {reply}"
+
+    def tenant(self, name):
+        """The household in the directory 'name', loaded on first use."""
+        directory = os.path.normpath(os.path.join(self.root, name))
+        tenant = self.tenants.get(directory)
+        if tenant is None:
+            if os.path.commonpath([self.root, directory]) != self.root:
+                raise ValueError(f"{name} is outside of the daemon's root")
+            if not os.path.exists(os.path.join(directory, 'settings.json')):
+                raise ValueError(f"there is no settings.json in {name}")
+            tenant = self.tenants[directory] = Tenant(directory)
+        return tenant
+
+    def add(self, household, total, *amounts):
+        tenant = self.tenant(household)
+        date = datetime.date.today()
+        if amounts and DATE.fullmatch(amounts[-1]):
+            date = datetime.date.fromisoformat(amounts[-1])
+            amounts = amounts[:-1]
+        if len(amounts) != len(tenant.categories):
+            raise ValueError(f"{household} needs amounts of {', '.join(tenant.categories)}")
+        entry = ShoppingStatsKeeper.parse_amounts(
+            total, dict(zip(tenant.categories, amounts)),
+            tenant.settings["vegetarian?"], tenant.categories
+        )
+
+        ShoppingStatsKeeper.save_new_entry(date, tenant.data, entry)
+        tenant.pending.append((date, entry))
+
+        self.unsaved += 1
+        if self.unsaved >= self.flush_entries:
+            self.wakeup.set()
+
+    def report(self, household, date=None):
+        tenant = self.tenant(household)
+        date = datetime.date.fromisoformat(date) if date else datetime.date.today()
+        month = ShoppingStatsKeeper.month_name(ShoppingStatsKeeper.month_key(date) - 1)
+        average = tenant.data["average"].get(month)
+        settings = tenant.settings
+
+        try:
+            report = ShoppingStatsKeeper.compute_report(
+                settings["vegetarian?"], settings["currency"], settings["goal"],
+                tenant.data, date, settings.get("window", 3), settings.get("gaps", "strict"),
+                tenant=tenant.json_file, categories=tenant.categories
+            )
+        except KeyError:
+            return "null"
+
+        if tenant.data["average"][month] != average:
+            tenant.averages_changed = True
+        return json.dumps(report._asdict())
+
+    def goal(self, household, goal):
+        if not goal.isdigit():
+            raise ValueError("the goal must be a whole number")
+        tenant = self.tenant(household)
+        tenant.settings["goal"] = goal
+        tenant.settings_changed = True
+
+    def flush(self):
+        saved = sum(tenant.flush() for tenant in self.tenants.values())
+        self.unsaved = 0
+        return saved
+
+    def ping(self):
+        pass
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def run_flushes(self):
+        """Flush every flush_interval seconds (or sooner when flush_entries
+        entries are waiting) until stopped, and once more at the end.
+        """
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            with self.lock:
+                self.flush()
+        with self.lock:
+            self.flush()
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.ssk_daemon
+        for line in self.rfile:
+            self.wfile.write(daemon.handle(line.decode()).encode() + b"\n")
+            if daemon.stopped.is_set():
+                self.server.shutdown()
+                break
+
+def serve(root='.', socket_path=SOCKET, ready=None, **options):
+    """Answer requests on 'socket_path' until a STOP request (or Ctrl+C),
+    see Daemon for the options. 'ready' (a threading.Event) is set once
+    the socket accepts connections.
+    """
+    if os.path.exists(socket_path):
+        try:
+            Client(socket_path).close()
+        except OSError:
+            os.remove(socket_path) # left behind by a daemon that was killed
+        else:
+            raise RuntimeError(f"a daemon is already answering on {socket_path}")
+
+    daemon = Daemon(root, **options)
+    flusher = threading.Thread(target=daemon.run_flushes)
+    flusher.start()
+
+    with socketserver.ThreadingUnixStreamServer(socket_path, _RequestHandler) as server:
+        server.daemon_threads = True
+        server.ssk_daemon = daemon
+        if ready is not None:
+            ready.set()
+        try:
+            server.serve_forever()
+        finally:
+            daemon.stop()
+            flusher.join()
+            os.remove(socket_path)
+
+class Client:
+    """A connection to the daemon, e.g. Client('ssk.sock').request("PING")."""
+
+    def __init__(self, socket_path=SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX)
+        try:
+            self.sock.connect(socket_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.replies = self.sock.makefile('rb')
+
+    def request(self, line):
+        """Send one request and return its reply."""
+        return self.pipeline([line])[0]
+
+    def pipeline(self, lines):
+        """Send many requests at once and return their replies in order."""
+        self.sock.sendall("".join(line + "\n" for line in lines).encode())
+        return [self.replies.readline().decode().rstrip("\n") for _ in lines]
+
+    def close(self):
+        self.replies.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def benchmark(count=10000, batch=100):
+    """Print the latency of single ADD requests and the throughput of
+    requests sent 'batch' at a time, against a daemon on a temporary household.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        ShoppingStatsKeeper.save_to_json(
+            os.path.join(directory, 'settings.json'),
+            {"currency": "PLN", "vegetarian?": "no", "goal": "800"}
+        )
+        socket_path = os.path.join(directory, SOCKET)
+        ready = threading.Event()
+        server = threading.Thread(target=serve, args=(directory, socket_path, ready))
+        server.start()
+        ready.wait()
+
+        with Client(socket_path) as client:
+            start = time.perf_counter()
+            for _ in range(count):
+                client.request("ADD . 120 20 15 2019-05-08")
+            elapsed = time.perf_counter() - start
+            print(f"ADD one at a time: {elapsed / count * 1e6:.0f} us a request")
+
+            start = time.perf_counter()
+            for _ in range(count // batch):
+                client.pipeline(["ADD . 120 20 15 2019-05-08"] * batch)
+            elapsed = time.perf_counter() - start
+            print(f"ADD {batch} at a time: {count / elapsed:.0f} requests/s")
+
+            start = time.perf_counter()
+            for _ in range(count):
+                client.request("REPORT . 2019-06-01")
+            elapsed = time.perf_counter() - start
+            print(f"REPORT: {elapsed / count * 1e6:.0f} us a request")
+
+            client.request("STOP")
+        server.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", nargs="?", default=".", help="directory with one or many households")
+    parser.add_argument("--socket", default=SOCKET)
+    parser.add_argument("--flush-interval", type=float, default=FLUSH_INTERVAL, help="seconds")
+    parser.add_argument("--flush-entries", type=int, default=FLUSH_ENTRIES)
+    parser.add_argument("--benchmark", action="store_true", help="only print how fast it is")
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        benchmark()
+        return 0
+
+    # stop (saving everything) on kill too, not only on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        serve(args.root, args.socket, flush_interval=args.flush_interval,
+              flush_entries=args.flush_entries)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""Sending many reports at once, e.g. everything run_reports made at the
+start of a month.
+
+A small pool of SMTP connections is shared by asyncio workers; each
+connection sends a batch of messages before it is replaced. Messages
+that still fail after a few retries are written to an outbox directory
+as .eml files and can be sent later with resend_outbox.
+"""
+import asyncio
+from email import message_from_binary_file, policy
+import json
+import os
+import smtplib
+import time
+import ShoppingStatsKeeper
+
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 465
+OUTBOX = 'outbox'
+
+def smtp_ssl_connection():
+    """A logged in connection to the Gmail SMTP server (the default).
+    Any callable returning an object with send_message() and quit()
+    can be used instead, e.g. lambda: smtplib.SMTP('localhost', 1025)
+    for a local test server.
+    """
+    smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
+    smtp.login(ShoppingStatsKeeper.EMAIL_ADDRESS, ShoppingStatsKeeper.EMAIL_PASSWORD)
+    return smtp
+
+async def deliver(messages, connect=None, connections=4,
+                  batch_size=100, retries=3, backoff=1.0, outbox=OUTBOX, on_done=None):
+    """Send the messages over at most 'connections' SMTP connections
+    (made by 'connect', smtp_ssl_connection by default), 'batch_size'
+    messages per connection. A failed message is retried on a new
+    connection after backoff, 2 * backoff, 4 * backoff... seconds.
+    A message failing with anything else than an SMTP or network error
+    is not retried but goes to the outbox at once, the others are still sent.
+    on_done(msg), if given, is called as soon as a message is sent or
+    written to the outbox.
+    Returns the number of sent messages and the outbox files
+    of the ones that failed.
+    """
+    if connect is None:
+        connect = smtp_ssl_connection
+    queue = asyncio.Queue()
+    for msg in messages:
+        queue.put_nowait(msg)
+
+    sent = 0
+    failed = []
+
+    async def worker():
+        nonlocal sent
+        smtp = None
+        sent_on_connection = 0
+
+        while not queue.empty():
+            msg = queue.get_nowait()
+
+            for attempt in range(retries + 1):
+                try:
+                    if smtp is None:
+                        smtp = await asyncio.to_thread(connect)
+                        sent_on_connection = 0
+                    await asyncio.to_thread(smtp.send_message, msg)
+
+                except (smtplib.SMTPException, OSError):
+                    smtp = await _close(smtp)
+                    if attempt == retries:
+                        failed.append(save_to_outbox(outbox, msg))
+                        if on_done is not None:
+                            on_done(msg)
+                    else:
+                        await asyncio.sleep(backoff * 2 ** attempt)
+
+                except Exception:
+                    smtp = await _close(smtp)
+                    failed.append(save_to_outbox(outbox, msg))
+                    if on_done is not None:
+                        on_done(msg)
+                    break
+
+                else:
+                    sent += 1
+                    sent_on_connection += 1
+                    if on_done is not None:
+                        on_done(msg)
+                    if sent_on_connection >= batch_size:
+                        smtp = await _close(smtp)
+                    break
+
+        await _close(smtp)
+
+    await asyncio.gather(*(worker() for _ in range(min(connections, queue.qsize()))))
+    return sent, failed
+
+async def _close(smtp):
+    """Quit the connection, ignoring errors of an already broken one."""
+    if smtp is not None:
+        try:
+            await asyncio.to_thread(smtp.quit)
+        except (smtplib.SMTPException, OSError):
+            pass
+
+def save_to_outbox(outbox, msg):
+    """Write a message that couldn't be sent to the outbox, return its path."""
+    os.makedirs(outbox, exist_ok=True)
+    path = os.path.join(outbox, f"{time.time_ns()}-{os.getpid()}-{id(msg)}.eml")
+    with open(path, 'wb') as f:
+        f.write(msg.as_bytes())
+    return path
+
+def resend_outbox(outbox=OUTBOX, **options):
+    """Try to send the messages in the outbox again (see deliver for the
+    options). A file is only removed once its message is sent (or saved
+    again as a new file after failing again), so nothing is lost if the
+    process stops on the way. Returns the number of sent messages.
+    """
+    paths = sorted(
+        os.path.join(outbox, name) for name in os.listdir(outbox) if name.endswith(".eml")
+    ) if os.path.isdir(outbox) else []
+
+    messages = []
+    files = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            msg = message_from_binary_file(f, policy=policy.default)
+        messages.append(msg)
+        files[id(msg)] = path
+
+    sent, _ = send_messages(
+        messages, outbox=outbox, on_done=lambda msg: os.remove(files[id(msg)]), **options
+    )
+    return sent
+
+def send_reports(tenant_reports, **options):
+    """Email the reports returned by run_reports, each to the "email"
+    in the household's settings.json (EMAIL_ADDRESS if there is none).
+    """
+    messages = []
+    for directory, report in tenant_reports:
+        if report is None:
+            continue
+        with open(os.path.join(directory, 'settings.json')) as f:
+            address = json.load(f).get("email")
+        messages.append(ShoppingStatsKeeper.make_email(report.msg_content, address))
+
+    return send_messages(messages, **options)
+
+def send_messages(messages, **options):
+    """deliver() the messages from synchronous code, e.g. the command line."""
+    return asyncio.run(deliver(messages, **options))
+
+class _NullSMTP:
+    """Stand-in connection for the benchmark, 'latency' seconds a message."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def send_message(self, msg):
+        time.sleep(self.latency)
+
+    def quit(self):
+        pass
+
+def benchmark(count=2000, connections=(1, 4, 16), latency=0.002):
+    """Print how many messages a second are sent with different pool sizes
+    when every message takes 'latency' seconds on the wire.
+    """
+    messages = [ShoppingStatsKeeper.make_email("Benchmark", "test@example.com")] * count
+
+    for size in connections:
+        start = time.perf_counter()
+        asyncio.run(deliver(messages, lambda: _NullSMTP(latency), connections=size))
+        elapsed = time.perf_counter() - start
+        print(f"{size:>3} connections: {count / elapsed:.0f} messages/s")
+
+if __name__ == '__main__':
+    benchmark()
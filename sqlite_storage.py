@@ -0,0 +1,183 @@
+"""SQLite storage for ShoppingStatsKeeper, an alternative to data.json.
+
+Every entry is a row with its real date, and the monthly aggregates
+(count, sums and the averages made by do_statistics) live in their own
+table keyed by the month key (year * 12 + month - 1), so a report only
+reads the few months it needs with a range query on the primary key.
+The functions return and accept the same {"weekly", "average", "running"}
+dictionaries as load_json, so the rest of the program works unchanged.
+Only the default [total, meat, extra] entries fit in the table, households
+with their own "categories" have to use data.json or the shards.
+"""
+import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import ShoppingStatsKeeper
+from ShoppingStatsKeeper import month_key, month_name, parse_month
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    day TEXT NOT NULL,
+    month INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    meat INTEGER NOT NULL,
+    extra INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_month ON entries (month);
+CREATE TABLE IF NOT EXISTS months (
+    month INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    meat INTEGER NOT NULL DEFAULT 0,
+    extra INTEGER NOT NULL DEFAULT 0,
+    average TEXT
+);
+"""
+
+def connect(db_file):
+    """Open (and if needed create) the database."""
+    conn = sqlite3.connect(db_file)
+    conn.executescript(SCHEMA)
+    return conn
+
+def check_entry(entry):
+    """Raise ValueError unless the entry is [total, meat, extra]."""
+    if len(entry) != 3:
+        raise ValueError("SQLite storage only keeps [total, meat, extra] entries")
+
+def save_entry(conn, date, new_entry):
+    """Store one entry and add it to its month's aggregates."""
+    check_entry(new_entry)
+    month = month_key(date)
+    with conn:
+        conn.execute(
+            "INSERT INTO entries (day, month, total, meat, extra) VALUES (?, ?, ?, ?, ?)",
+            (date.isoformat(), month, *new_entry)
+        )
+        conn.execute(
+            "INSERT INTO months (month, count, total, meat, extra) VALUES (?, 1, ?, ?, ?) "
+            "ON CONFLICT (month) DO UPDATE SET count = count + 1, "
+            "total = total + excluded.total, meat = meat + excluded.meat, "
+            "extra = extra + excluded.extra",
+            (month, *new_entry)
+        )
+
+def save_averages(conn, data):
+    """Write the months in data["average"] back to the database."""
+    with conn:
+        conn.executemany(
+            "INSERT INTO months (month, average) VALUES (?, ?) "
+            "ON CONFLICT (month) DO UPDATE SET average = excluded.average",
+            [(parse_month(month), json.dumps(average))
+             for month, average in data["average"].items()]
+        )
+
+def load_months(conn, first, last):
+    """Load the months from 'first' to 'last' (month keys, both included)
+    into a dictionary in the load_json format.
+    """
+    data = {"weekly": {}, "average": {}, "running": {}}
+
+    for month, count, total, meat, extra, average in conn.execute(
+        "SELECT month, count, total, meat, extra, average FROM months "
+        "WHERE month BETWEEN ? AND ? ORDER BY month", (first, last)
+    ):
+        if count:
+            data["running"][month_name(month)] = [count, total, meat, extra]
+        if average is not None:
+            data["average"][month_name(month)] = json.loads(average)
+
+    for month, total, meat, extra in conn.execute(
+        "SELECT month, total, meat, extra FROM entries "
+        "WHERE month BETWEEN ? AND ? ORDER BY id", (first, last)
+    ):
+        data["weekly"].setdefault(month_name(month), []).append([total, meat, extra])
+
+    return data
+
+def load_report_window(conn, date, window=3):
+    """Load only the months a run on 'date' can use: the current month,
+    the reported month and the 'window' months it is compared with.
+    """
+    current = month_key(date)
+    return load_months(conn, current - window - 1, current)
+
+def has_history(conn, date):
+    """Is there anything stored before the month of 'date'?"""
+    return conn.execute(
+        "SELECT EXISTS (SELECT 1 FROM months WHERE month < ?)", (month_key(date),)
+    ).fetchone()[0] == 1
+
+def migrate_json(json_file, db_file, journal_file=None):
+    """Copy a data.json (and its journal) into a new database.
+    data.json doesn't know the days of its entries, so they are stored
+    under the first day of their month.
+    """
+    data = ShoppingStatsKeeper.load_json(
+        json_file, journal_file or os.path.join(os.path.dirname(json_file), ShoppingStatsKeeper.JOURNAL_FILE)
+    )
+    conn = connect(db_file)
+
+    rows = []
+    for month, entries in data["weekly"].items():
+        key = parse_month(month)
+        first_day = datetime.date(key // 12, key % 12 + 1, 1).isoformat()
+        for entry in entries:
+            check_entry(entry)
+            rows.append((first_day, key, *entry))
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO entries (day, month, total, meat, extra) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.execute(
+            "INSERT INTO months (month, count, total, meat, extra) "
+            "SELECT month, COUNT(*), SUM(total), SUM(meat), SUM(extra) FROM entries "
+            "WHERE true GROUP BY month "
+            "ON CONFLICT (month) DO UPDATE SET count = excluded.count, "
+            "total = excluded.total, meat = excluded.meat, extra = excluded.extra"
+        )
+
+    save_averages(conn, data)
+    return conn
+
+def benchmark(years=(1, 5, 10, 25, 50), entries_per_month=8):
+    """Time one monthly run (load, add an entry, save) with data.json and
+    with SQLite for histories of different lengths and print the results.
+    """
+    print(f"{'years':>6} {'json ms':>10} {'sqlite ms':>10}")
+
+    for length in years:
+        with tempfile.TemporaryDirectory() as directory:
+            json_file = os.path.join(directory, 'data.json')
+            db_file = os.path.join(directory, 'data.db')
+            journal_file = os.path.join(directory, ShoppingStatsKeeper.JOURNAL_FILE)
+
+            today = datetime.date(2000 + length, 1, 1)
+            data = {"weekly": {}, "average": {}}
+            for key in range(month_key(today) - length * 12, month_key(today)):
+                data["weekly"][month_name(key)] = [[100, 20, 10]] * entries_per_month
+            ShoppingStatsKeeper.save_to_json(json_file, data)
+            migrate_json(json_file, db_file, journal_file).close()
+
+            start = time.perf_counter()
+            data = ShoppingStatsKeeper.load_json(json_file, journal_file)
+            ShoppingStatsKeeper.save_new_entry(today, data, [100, 20, 10])
+            ShoppingStatsKeeper.save_to_json(json_file, data)
+            json_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            conn = connect(db_file)
+            save_entry(conn, today, [100, 20, 10])
+            load_report_window(conn, today)
+            conn.close()
+            sqlite_time = time.perf_counter() - start
+
+        print(f"{length:>6} {json_time * 1000:>10.2f} {sqlite_time * 1000:>10.2f}")
+
+if __name__ == '__main__':
+    benchmark()
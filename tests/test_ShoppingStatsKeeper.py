@@ -1,17 +1,38 @@
+import copy
 import datetime
+import importlib.util
 from dateutil.relativedelta import relativedelta
 from freezegun import freeze_time
 import json
+import multiprocessing
 import os
+import random
 import ShoppingStatsKeeper
+import statistics
+import tempfile
 import unittest
 from unittest.mock import patch
 
+def add_entries(directory, writer, count=30):
+    """Add entries from a separate process, folding the journal now and then."""
+    json_file = os.path.join(directory, "data.json")
+    journal_file = os.path.join(directory, "data.journal")
+    for i in range(count):
+        ShoppingStatsKeeper.append_to_journal(journal_file, datetime.date(2019, 5, 1), [writer, i, 0])
+        if i % 7 == 0:
+            ShoppingStatsKeeper.compact_journal(json_file, journal_file)
+
+def add_shard_entries(shard_dir, writer, count=30):
+    """Add entries to a month's shard from a separate process."""
+    for i in range(count):
+        ShoppingStatsKeeper.add_to_shard(shard_dir, datetime.date(2019, 5, 1), [writer, i, 0])
+
 class TestApp(unittest.TestCase):
 
     def setUp(self):
 
         self.maxDiff = None
+        ShoppingStatsKeeper.forget_reports()
 
         self.data = {
             "weekly": {        
@@ -35,7 +56,7 @@ class TestApp(unittest.TestCase):
             "\nOn average you spent 162 PLN a week, 36 on meat and 42 on "
             "extra items.\nWhen there is enough data, I will tell "
             "you how the reported month compares to the average of "
-            "the three previous ones.\nStay tuned."
+            "the previous 3 months.\nStay tuned."
         )
 
         self.long_message = (
@@ -54,6 +75,23 @@ class TestApp(unittest.TestCase):
             "better luck next time."
         )
 
+    def make_households(self, *households):
+        """A temporary directory with a directory of settings.json and data.json
+        for every (name, data[, settings]) household, self.settings by default.
+        Returns the directory and the households' directories.
+        """
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        directories = []
+        for name, data, *settings in households:
+            directories.append(os.path.join(root.name, name))
+            os.mkdir(directories[-1])
+            ShoppingStatsKeeper.save_to_json(
+                os.path.join(directories[-1], "settings.json"), settings[0] if settings else self.settings
+            )
+            ShoppingStatsKeeper.save_to_json(os.path.join(directories[-1], "data.json"), data)
+        return root.name, directories
+
     def test_load_settings_existing(self):
         """Does it load from the existing json?"""
         ShoppingStatsKeeper.load_settings('fixtures/test_existing_settings.json')
@@ -188,6 +226,721 @@ class TestApp(unittest.TestCase):
                 #mocked_print.assert_called_with("Oops, something went wrong. Try again with 'yes' or 'no'")
 
         self.addCleanup(os.remove, 'test_settings.json')
+
+    def test_journal_replayed_by_load_json(self):
+        """Are journal entries added on top of the snapshot when loading?"""
+
+        ShoppingStatsKeeper.save_to_json("test_data.json", self.short_data)
+        ShoppingStatsKeeper.save_new_entry(
+            datetime.date(2019, 4, 20), {"weekly": {}, "average": {}}, [1, 2, 3], "test.journal"
+        )
+        ShoppingStatsKeeper.save_new_entry(
+            datetime.date(2019, 5, 2), {"weekly": {}, "average": {}}, [4, 5, 6], "test.journal"
+        )
+        self.addCleanup(os.remove, "test_data.json")
+        self.addCleanup(os.remove, "test.journal")
+        self.addCleanup(os.remove, "test.journal.lock")
+
+        result = ShoppingStatsKeeper.load_json("test_data.json", "test.journal")
+        self.assertEqual([stat["count"] for stat in result.pop("stats")["trips"]], [4, 4, 4])
+        self.assertEqual(
+            result.pop("rollup"),
+            {
+                "week": {"2019-W16": [1, 1, 2, 3], "2019-W18": [1, 4, 5, 6]},
+                "quarter": {"2019-Q2": [4, 328, 80, 92]},
+                "year": {"2019": [4, 328, 80, 92]}
+            }
+        )
+        self.assertEqual(
+            result,
+            {
+                "weekly": {
+                    "April 2019": [[123, 23, 23], [200, 50, 60], [1, 2, 3]],
+                    "May 2019": [[4, 5, 6]]
+                },
+                "average": {},
+                "running": {"April 2019": [3, 324, 75, 86], "May 2019": [1, 4, 5, 6]}
+            }
+        )
+
+    def test_load_json_missing(self):
+        """Is a missing json file an empty history, without writing it?"""
+
+        data = ShoppingStatsKeeper.load_json("test_missing.json", "test_missing.journal")
+
+        self.assertEqual((data["weekly"], data["average"]), ({}, {}))
+        self.assertFalse(os.path.exists("test_missing.json"))
+
+    def test_compact_journal(self):
+        """Does compaction write the snapshot and empty the journal?"""
+
+        ShoppingStatsKeeper.save_to_json("test_data.json", self.short_data)
+        with open("test.journal", "w") as f:
+            f.write('{"date": "2019-05-02", "entry": [4, 5, 6]}\n{"date": "2019-05-0')
+        self.addCleanup(os.remove, "test_data.json")
+        self.addCleanup(os.remove, "test.journal")
+        self.addCleanup(os.remove, "test.journal.lock")
+
+        # The torn last line should be ignored
+        data = ShoppingStatsKeeper.load_json("test_data.json", "test.journal")
+        ShoppingStatsKeeper.compact_journal("test_data.json", "test.journal", data)
+
+        self.assertEqual(list(ShoppingStatsKeeper.read_journal("test.journal")), [])
+        with open("test_data.json") as f:
+            self.assertEqual(json.load(f)["weekly"]["May 2019"], [[4, 5, 6]])
+
+        # An entry appended after a torn line is kept
+        with open("test.journal", "a") as f:
+            f.write('{"date": "2019-05-0')
+        ShoppingStatsKeeper.append_to_journal("test.journal", datetime.date(2019, 5, 3), [7, 8, 9])
+        ShoppingStatsKeeper.append_to_journal("test.journal", datetime.date(2019, 5, 4), [1, 1, 1])
+        self.assertEqual(
+            [entry for _, entry in ShoppingStatsKeeper.read_journal("test.journal")], [[7, 8, 9], [1, 1, 1]]
+        )
+
+        # Killed after the snapshot was written but before the journal was emptied
+        with open("test.journal") as f:
+            journal = f.read()
+        ShoppingStatsKeeper.compact_journal("test_data.json", "test.journal")
+        with open("test.journal", "w") as f:
+            f.write(journal)
+        data = ShoppingStatsKeeper.load_json("test_data.json", "test.journal")
+        self.assertEqual(data["weekly"]["May 2019"], [[4, 5, 6], [7, 8, 9], [1, 1, 1]])
+
+    @freeze_time("2019-05-08")
+    def test_do_statistics_columns(self):
+        """Is the report the same when months are stored in columns?"""
+
+        ShoppingStatsKeeper.to_columns(self.data)
+        self.assertIsInstance(self.data["weekly"]["April 2019"], ShoppingStatsKeeper.MonthColumns)
+
+        ShoppingStatsKeeper.do_statistics("no", "PLN", "500", self.data, datetime.date.today())
+        self.assertEqual(ShoppingStatsKeeper.msg_content, self.long_message)
+        self.assertEqual(
+            ShoppingStatsKeeper.monthly_averages(self.data, ["March 2019", "April 2019", "May 2019"]),
+            {"April 2019": [234, 15, 27, 702], "May 2019": [73, 12, 13, 146]}
+        )
+
+        ShoppingStatsKeeper.save_to_json("test.json", self.data)
+        self.addCleanup(os.remove, "test.json")
+        with open("test.json") as f:
+            self.assertEqual(f.read().count("[[123, 23, 23], [456, 23, 34], [123, 0, 23]]"), 1)
+
+    def test_running_aggregates(self):
+        """Are the month's aggregates kept up to date with every entry?"""
+
+        ShoppingStatsKeeper.rebuild_aggregates(self.data)
+        self.assertEqual(self.data["running"]["May 2019"], [2, 146, 25, 26])
+
+        ShoppingStatsKeeper.save_new_entry(datetime.date(2019, 5, 20), self.data, [10, 5, 1])
+        ShoppingStatsKeeper.save_new_entry(datetime.date(2019, 6, 1), self.data, [7, 0, 2])
+        self.assertEqual(self.data["running"]["May 2019"], [3, 156, 30, 27])
+        self.assertEqual(self.data["running"]["June 2019"], [1, 7, 0, 2])
+        self.assertEqual(ShoppingStatsKeeper.month_summary(self.data, "May 2019"), [52, 10, 9, 156])
+        self.assertEqual(ShoppingStatsKeeper.check_aggregates(self.data), [])
+
+        # Entries added behind its back are found and the aggregates rebuilt
+        self.data["weekly"]["May 2019"].append([4, 4, 4])
+        self.assertEqual(ShoppingStatsKeeper.check_aggregates(self.data), ["May 2019"])
+        self.assertEqual(self.data["running"]["May 2019"], [4, 160, 34, 31])
+
+    def test_bulk_import(self):
+        """Are the rows put into the months of their dates and the bad ones skipped?"""
+
+        with open("test_import.csv", "w") as f:
+            f.write(
+                "date,total,meat,extra\n"
+                "2019-03-30,100,20,10\n"
+                "2019-04-02,50,x,5\n"
+                "2019-04-03,60,10,5\n"
+                "not a date,1,1,1\n"
+            )
+        ShoppingStatsKeeper.save_to_json("test_data.json", self.short_data)
+        self.addCleanup(os.remove, "test_import.csv")
+        self.addCleanup(os.remove, "test_data.json")
+        self.addCleanup(os.remove, "test.journal")
+        self.addCleanup(os.remove, "test.journal.lock")
+
+        with patch('builtins.print'):
+            result = ShoppingStatsKeeper.bulk_import(
+                "test_import.csv", "no", "test_data.json", "test.journal"
+            )
+        self.assertEqual(result, (2, 2))
+
+        with open("test_data.json") as f:
+            self.assertEqual(
+                json.load(f)["weekly"],
+                {
+                    "March 2019": [[100, 20, 10]],
+                    "April 2019": [[123, 23, 23], [200, 50, 60], [60, 10, 5]]
+                }
+            )
+
+    def test_parse_amounts_vegetarian(self):
+        """Are meat expenses refused for vegetarians?"""
+
+        self.assertEqual(ShoppingStatsKeeper.parse_amounts("10", {"meat": "", "extra": 3}, "yes"), [10, 0, 3])
+        with self.assertRaises(ValueError):
+            ShoppingStatsKeeper.parse_amounts("10", {"meat": "5", "extra": "3"}, "yes")
+
+    def test_run_reports(self):
+        """Are the reports made in parallel the same as the serial ones?"""
+
+        self.settings["goal"] = "500"
+        root, _ = self.make_households(
+            ("a", self.data), ("b", self.short_data), ("c", {"weekly": {}, "average": {}})
+        )
+
+        with patch('builtins.print'):
+            serial = ShoppingStatsKeeper.run_reports(root, datetime.date(2019, 5, 8), 1)
+            ShoppingStatsKeeper.forget_reports()
+            parallel = ShoppingStatsKeeper.run_reports(root, datetime.date(2019, 5, 8), 2)
+
+        self.assertEqual(serial, parallel)
+        self.assertEqual([os.path.basename(d) for d, _ in serial], ["a", "b", "c"])
+        self.assertEqual(serial[0][1].msg_content, self.long_message)
+        self.assertIsNone(serial[2][1])
+
+    def test_month_keys(self):
+        """Do month keys translate to and from the names in the json file?"""
+
+        key = ShoppingStatsKeeper.month_key(datetime.date(2019, 1, 31))
+        self.assertEqual(ShoppingStatsKeeper.month_name(key), "January 2019")
+        self.assertEqual(ShoppingStatsKeeper.month_name(key - 1), "December 2018")
+        self.assertEqual(ShoppingStatsKeeper.parse_month("December 2018"), key - 1)
+
+        index = ShoppingStatsKeeper.month_index(self.data)
+        names = lambda keys: [ShoppingStatsKeeper.month_name(k) for k in keys]
+        self.assertEqual(len(index), 5)
+        self.assertEqual(
+            names(index.before(ShoppingStatsKeeper.parse_month("April 2019"), 2)),
+            ["February 2019", "March 2019"]
+        )
+        self.assertEqual(
+            names(index.between(key + 2, key + 10)), ["March 2019", "April 2019", "May 2019"]
+        )
+        index.add(key - 5)
+        self.assertIn(key - 5, index)
+        self.assertEqual(names(index.before(key + 1, 3)), ["August 2018", "January 2019"])
+
+    def test_rolling_window(self):
+        """Are windows of any length compared and gaps handled as asked?"""
+
+        rolling = ShoppingStatsKeeper.RollingWindow(self.data, 3)
+        april = ShoppingStatsKeeper.parse_month("April 2019")
+        self.assertEqual(rolling.compare(april), [272, 52, 59])
+        self.assertIsNone(rolling.compare(april - 1))
+
+        self.assertEqual(
+            ShoppingStatsKeeper.rolling_history(self.data, 2, "skip"),
+            {
+                "January 2019": None, "February 2019": [120, 55, 44],
+                "March 2019": [180, 72, 72], "April 2019": [348, 50, 66]
+            }
+        )
+
+        # A year back there are only the four months, enough when skipping gaps
+        report = ShoppingStatsKeeper.compute_report(
+            "no", "PLN", "500", self.data, datetime.date(2019, 6, 3), 12, "skip"
+        )
+        self.assertIn("the average of the previous 4 months...", report.msg_content)
+        self.assertIn("compared to 379 PLN", report.msg_content)
+        self.assertIn("in the previous 4 months.", report.msg_content)
+
+        report = ShoppingStatsKeeper.compute_report(
+            "no", "PLN", "500", self.data, datetime.date(2019, 6, 3), 12, "strict"
+        )
+        self.assertIn("compares to the average of the previous 12 months.\nStay tuned.", report.msg_content)
+
+        report = ShoppingStatsKeeper.compute_report(
+            "no", "PLN", "500", self.data, datetime.date(2019, 6, 3), 1
+        )
+        self.assertIn("the average of the previous month...", report.msg_content)
+
+    def test_shards(self):
+        """Is every month saved to its own file and only the report window loaded?"""
+
+        shard_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(shard_dir.cleanup)
+        self.data["weekly"]["October 2018"] = [[1, 1, 1]]
+        ShoppingStatsKeeper.save_shards(shard_dir.name, self.data)
+
+        self.assertIn("2019-04.json", os.listdir(shard_dir.name))
+        self.assertEqual(len(ShoppingStatsKeeper.shard_months(shard_dir.name)), 6)
+
+        window = ShoppingStatsKeeper.load_window(shard_dir.name, datetime.date(2019, 5, 8))
+        self.assertNotIn("October 2018", window["weekly"])
+        self.assertEqual(window["weekly"]["April 2019"], self.data["weekly"]["April 2019"])
+        self.assertEqual(window["average"], self.data["average"])
+
+        report = ShoppingStatsKeeper.compute_report("no", "PLN", "500", window, datetime.date(2019, 5, 8))
+        self.assertEqual(report.msg_content, self.long_message)
+
+    def test_stage_metrics(self):
+        """Are stages measured only when profiling is on?"""
+
+        with ShoppingStatsKeeper.stage("nothing"):
+            pass
+        self.assertEqual(ShoppingStatsKeeper.metrics, [])
+
+        with open("test.json", "w") as f:
+            f.write("{}")
+        self.addCleanup(os.remove, "test.json")
+        self.addCleanup(os.remove, "test_metrics.jsonl")
+
+        with patch.object(ShoppingStatsKeeper, "PROFILE", "test_metrics.jsonl"):
+            with ShoppingStatsKeeper.stage("load", read=["test.json", "missing.json"]):
+                pass
+            ShoppingStatsKeeper.report_metrics()
+
+        self.assertEqual(ShoppingStatsKeeper.metrics, [])
+        with open("test_metrics.jsonl") as f:
+            record = json.loads(f.readline())
+        self.assertEqual((record["stage"], record["read_bytes"], record["written_bytes"]), ("load", 2, 0))
+        self.assertIn("seconds", record)
+        self.assertIn("allocated_blocks", record)
+
+    def test_cli(self):
+        """Do the commands work without asking any questions?"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        ShoppingStatsKeeper.save_to_json('settings.json', self.settings)
+
+        with patch('builtins.input') as mocked_input, patch('builtins.print'):
+            ShoppingStatsKeeper.cli(["add", "--total", "55", "--meat", "23", "--extra", "3", "--date", "2019-04-02"])
+            ShoppingStatsKeeper.cli(["add", "--total", "45", "--meat", "7", "--extra", "1", "--date", "2019-04-30"])
+            ShoppingStatsKeeper.cli(["set-goal", "90"])
+            ShoppingStatsKeeper.cli(["report", "--date", "2019-05-01"])
+            mocked_input.assert_not_called()
+
+        with open('settings.json') as f:
+            self.assertEqual(json.load(f)["goal"], "90")
+        with open('data.json') as f:
+            self.assertEqual(json.load(f)["average"], {"April 2019": [50, 15, 2, 100]})
+        self.assertIn("so better luck next time.", ShoppingStatsKeeper.msg_content)
+
+        with self.assertRaises(SystemExit), patch('sys.stderr'):
+            ShoppingStatsKeeper.cli(["add", "--total", "ten", "--extra", "3"])
+
+        ShoppingStatsKeeper.save_to_json('settings.json', dict(self.settings, categories=["dairy", "produce"]))
+        with patch('builtins.print'):
+            ShoppingStatsKeeper.cli(["add", "--total", "30", "--amount", "dairy=10", "--amount", "produce=20", "--date", "2019-05-02"])
+        self.assertEqual(ShoppingStatsKeeper.load_json()["weekly"]["May 2019"], [[30, 10, 20]])
+        with self.assertRaises(SystemExit), patch('sys.stderr'):
+            ShoppingStatsKeeper.cli(["add", "--total", "30", "--amount", "dairy=10", "--meat", "5"])
+
+    def test_cli_storage(self):
+        """Do report and import use the "storage" setting, like add?"""
+
+        for storage in ("shards", "sqlite"):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.addCleanup(os.chdir, os.getcwd())
+            os.chdir(directory.name)
+            ShoppingStatsKeeper.save_to_json('settings.json', dict(self.settings, storage=storage))
+
+            with patch('builtins.print') as mocked_print:
+                ShoppingStatsKeeper.cli(["add", "--total", "55", "--meat", "23", "--extra", "3", "--date", "2019-06-02"])
+                ShoppingStatsKeeper.cli(["add", "--total", "45", "--meat", "7", "--extra", "1", "--date", "2019-06-30"])
+                ShoppingStatsKeeper.cli(["report", "--date", "2019-07-01"])
+            self.assertIn("There were 2 shopping days last month.", mocked_print.call_args_list[0][0][0])
+            self.assertFalse(os.path.exists('data.json'))
+            self.assertEqual(
+                ShoppingStatsKeeper.load_report_data(datetime.date(2019, 7, 1))["average"]["June 2019"],
+                [50, 15, 2, 100]
+            )
+
+            for command in (["import", "rows.csv"], ["report", "--period", "year"]):
+                with self.assertRaises(SystemExit), patch('sys.stderr'):
+                    ShoppingStatsKeeper.cli(command)
+
+    def test_categories(self):
+        """Are user-defined categories collected, averaged and compared together?"""
+
+        settings = dict(self.settings, categories=["produce", "dairy", "meat"])
+        categories = ShoppingStatsKeeper.categories_of(settings)
+        self.assertEqual(ShoppingStatsKeeper.categories_of(self.settings), ("meat", "extra"))
+        with self.assertRaises(ValueError):
+            ShoppingStatsKeeper.categories_of({"categories": ["dairy", "dairy"]})
+
+        with patch('builtins.input') as mocked_input, patch('builtins.print'):
+            mocked_input.side_effect = (90, 40, 20, 'yes')
+            ShoppingStatsKeeper.collect_data("yes", categories)
+        self.assertEqual(ShoppingStatsKeeper.new, [90, 40, 20, 0])
+
+        self.assertEqual(
+            ShoppingStatsKeeper.parse_amounts("90", {"produce": "40", "dairy": 20, "meat": "0"}, "no", categories),
+            [90, 40, 20, 0]
+        )
+        with self.assertRaises(ValueError):
+            ShoppingStatsKeeper.parse_amounts("90", {"produce": "40"}, "no", categories)
+        with self.assertRaises(ValueError):
+            ShoppingStatsKeeper.parse_amounts("90", {"produce": "40", "dairy": 20, "beer": 5}, "yes", categories)
+
+        # "dairy" and "meat" were only added in March
+        data = {
+            "weekly": {"April 2019": [[100, 50, 20, 10], [60, 30, 10, 0]]},
+            "average": {
+                "January 2019": [80, 40, 80], "February 2019": [100, 60, 100],
+                "March 2019": [120, 30, 30, 20, 240]
+            }
+        }
+        report = ShoppingStatsKeeper.compute_report("no", "PLN", "500", data, datetime.date(2019, 5, 2), categories=categories)
+
+        self.assertEqual(data["average"]["April 2019"], [80, 40, 15, 5, 160])
+        self.assertEqual(report.categories, (("produce", 40, 43), ("dairy", 15, 10), ("meat", 5, 7)))
+        self.assertEqual((report.aver_total, report.aver_meat, report.aver_extra), (80, 5, None))
+        self.assertIn("compared to 100 PLN", report.msg_content)
+        self.assertIn("\nDairy expenses: 15 PLN last month and 10 PLN in the previous 3 months.", report.msg_content)
+        self.assertIn("In March 2019 it was 240.", report.msg_content)
+
+        self.assertEqual(ShoppingStatsKeeper.graph_series(data, ["March 2019", "April 2019"])[1], [30, 40])
+        self.assertEqual(
+            ShoppingStatsKeeper.graph_series(data, ["February 2019", "March 2019", "April 2019"]),
+            [[100, 120, 80], [60, 30, 40], [0, 30, 15], [0, 20, 5], [100, 240, 160]]
+        )
+
+    def test_category_added_later(self):
+        """Are the entries of a month saved before and after a new category all kept?"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        json_file = os.path.join(directory.name, "data.json")
+        journal_file = os.path.join(directory.name, "data.journal")
+        import_file = os.path.join(directory.name, "import.jsonl")
+        ShoppingStatsKeeper.save_to_json(json_file, {"weekly": {"May 2019": [[100, 10, 5]]}, "average": {}})
+        with open(import_file, "w") as f:
+            f.write('{"date": "2019-05-20", "total": 50, "meat": 1, "extra": 2, "dairy": 3}\n')
+
+        with patch('builtins.print'):
+            ShoppingStatsKeeper.bulk_import(
+                import_file, "no", json_file, journal_file, ("meat", "extra", "dairy")
+            )
+
+        data = ShoppingStatsKeeper.load_json(json_file, journal_file)
+        self.assertEqual(data["weekly"]["May 2019"], [[100, 10, 5, 0], [50, 1, 2, 3]])
+        self.assertEqual(data["running"]["May 2019"], [2, 150, 11, 7, 3])
+        self.assertEqual(ShoppingStatsKeeper.check_aggregates(data), [])
+
+        data["weekly"]["May 2019"] = [[100, 10, 5], [50, 1, 2, 3]]
+        self.assertEqual(ShoppingStatsKeeper.monthly_sums(data, ["May 2019"]), {"May 2019": [2, 150, 11, 7, 3]})
+        self.assertEqual(ShoppingStatsKeeper.check_aggregates(data), [])
+
+    def test_streaming_stats(self):
+        """Are mean, variance and quantiles kept per column, mergeable and used for warnings?"""
+
+        rng = random.Random(1)
+        values = [rng.randint(0, 400) for _ in range(2000)]
+        first, second = ShoppingStatsKeeper.new_stat(), ShoppingStatsKeeper.new_stat()
+        for i, value in enumerate(values):
+            ShoppingStatsKeeper.add_value(first if i % 3 else second, value)
+        stat = ShoppingStatsKeeper.merge_stats(first, second)
+
+        self.assertEqual(stat["count"], 2000)
+        self.assertAlmostEqual(stat["mean"], statistics.mean(values))
+        self.assertAlmostEqual(ShoppingStatsKeeper.deviation(stat), statistics.stdev(values))
+        ordered = sorted(values)
+        for q in (0.1, 0.5, 0.9, 0.99):
+            exact = ordered[round(q * (len(values) - 1))]
+            self.assertLessEqual(abs(ShoppingStatsKeeper.quantile(stat, q) - exact), exact * 0.011 + 1)
+
+        data = {"weekly": {"April 2019": [[100 + i % 5, 20 + i % 3, 10] for i in range(20)]}, "average": {}}
+        ShoppingStatsKeeper.rebuild_stats(data)
+        self.assertEqual(ShoppingStatsKeeper.unusual_entry(data, [101, 21, 10], "PLN"), [])
+        self.assertEqual(
+            ShoppingStatsKeeper.unusual_entry(data, [180, 90, 10], "PLN"),
+            [
+                "That's unusual: 180 PLN in total, usually it's about 102 PLN.",
+                "That's unusual: 90 PLN on meat, usually it's about 21 PLN."
+            ]
+        )
+        ShoppingStatsKeeper.save_new_entry(datetime.date(2019, 4, 30), data, [180, 90, 10])
+        self.assertEqual(data["stats"]["trips"][1]["count"], 21)
+
+        # A year of similar months, then an expensive one
+        for key in range(ShoppingStatsKeeper.parse_month("April 2018"), ShoppingStatsKeeper.parse_month("April 2019")):
+            data["average"][ShoppingStatsKeeper.month_name(key)] = [100 + key % 4, 20 + key % 2, 10, 400 + key % 7]
+        ShoppingStatsKeeper.rebuild_stats(data)
+        report = ShoppingStatsKeeper.compute_report("no", "PLN", "500", data, datetime.date(2019, 5, 2))
+        self.assertEqual(data["stats"]["last_month"], ShoppingStatsKeeper.parse_month("April 2019"))
+        self.assertTrue(report.msg_content.endswith(
+            "\nUnusual for you: the average trip (106 PLN, usually about 102 PLN), "
+            "meat a trip (24 PLN, usually about 20 PLN) and the total (2220 PLN, usually about 403 PLN)."
+        ))
+
+    def test_fleet_stats(self):
+        """Are the stats of many households merged by category?"""
+
+        root, _ = self.make_households(
+            ("a", {"weekly": {"May 2019": [[100, 20, 10], [50, 0, 5]]}, "average": {}}),
+            ("b", {"weekly": {"May 2019": [[30, 10, 5]]}, "average": {}},
+             dict(self.settings, categories=["dairy", "meat"])),
+        )
+
+        stats = ShoppingStatsKeeper.fleet_stats(root, workers=1)
+        self.assertEqual(set(stats["trips"]), {"total", "meat", "extra", "dairy"})
+        self.assertEqual(stats["trips"]["total"]["count"], 3)
+        self.assertEqual(stats["trips"]["total"]["mean"], 60)
+        self.assertEqual(stats["trips"]["meat"]["count"], 3)
+        self.assertEqual(ShoppingStatsKeeper.quantile(stats["trips"]["meat"], 0.5), 5)
+        self.assertEqual(stats["trips"]["dairy"]["count"], 1)
+
+    def test_rollup(self):
+        """Are weeks, quarters and years summed as entries arrive and compared?"""
+
+        data = ShoppingStatsKeeper.rebuild_rollup(
+            ShoppingStatsKeeper.rebuild_aggregates({"weekly": {"February 2018": [[300, 50, 20]]}, "average": {}})
+        )
+        self.assertEqual(data["rollup"]["quarter"], {"2018-Q1": [1, 300, 50, 20]})
+        self.assertEqual(data["rollup"]["week"], {})
+
+        for day, entry in (
+            ("2018-04-03", [100, 20, 10]), ("2019-01-03", [50, 10, 5]),
+            ("2019-01-07", [70, 0, 30]), ("2019-03-31", [80, 30, 0])
+        ):
+            ShoppingStatsKeeper.save_new_entry(datetime.date.fromisoformat(day), data, entry)
+
+        self.assertEqual(ShoppingStatsKeeper.rollup(data, "week", "2019-W01"), [1, 50, 10, 5])
+        self.assertEqual(ShoppingStatsKeeper.rollup(data, "week", "2019-W02"), [1, 70, 0, 30])
+        self.assertEqual(ShoppingStatsKeeper.rollup(data, "month", "January 2019"), [2, 120, 10, 35])
+        self.assertEqual(ShoppingStatsKeeper.rollup(data, "quarter", "2019-Q1"), [3, 200, 40, 35])
+        self.assertEqual(ShoppingStatsKeeper.rollup(data, "year", "2018"), [2, 400, 70, 30])
+        self.assertEqual(
+            ShoppingStatsKeeper.rebuild_rollup(dict(data))["rollup"]["quarter"], data["rollup"]["quarter"]
+        )
+
+        date = datetime.date(2019, 4, 10)
+        self.assertEqual(ShoppingStatsKeeper.previous_periods("quarter", date, 3), ["2018-Q3", "2018-Q4", "2019-Q1"])
+        self.assertEqual(ShoppingStatsKeeper.previous_periods("week", date, 2), ["2019-W13", "2019-W14"])
+        self.assertEqual(ShoppingStatsKeeper.previous_periods("month", date, 2), ["February 2019", "March 2019"])
+        self.assertEqual(
+            ShoppingStatsKeeper.period_series(data, "year", ["2018"]), [[200], [35], [15], [400]]
+        )
+
+        self.assertEqual(
+            ShoppingStatsKeeper.period_report(data, "quarter", date, "PLN"),
+            "In 2019-Q1 you spent 200 PLN in 3 shopping trips, 67 PLN a trip, "
+            "40 PLN on meat and 35 PLN on extra items."
+            "\nThat's 33% less than in 2018-Q1 (300 PLN)."
+        )
+        self.assertEqual(
+            ShoppingStatsKeeper.period_report(data, "year", datetime.date(2019, 6, 1), "PLN"),
+            "In 2018 you spent 400 PLN in 2 shopping trips, 200 PLN a trip, "
+            "70 PLN on meat and 30 PLN on extra items."
+        )
+        self.assertIsNone(ShoppingStatsKeeper.period_report(data, "week", date, "PLN"))
+
+    def test_archive(self):
+        """Are old months moved to the archive, still reported on and restored?"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        json_file = os.path.join(directory.name, "data.json")
+        journal_file = os.path.join(directory.name, "data.journal")
+        archive_file = os.path.join(directory.name, "data.archive.gz")
+        self.data["weekly"]["March 2019"] = [[400, 10, 30], [510, 14, 38]]
+        ShoppingStatsKeeper.save_to_json(json_file, self.data)
+        date = datetime.date(2019, 5, 8)
+
+        with self.assertRaises(ValueError):
+            ShoppingStatsKeeper.archive_old_months(date, 1, json_file, journal_file, archive_file)
+        months = ShoppingStatsKeeper.archive_old_months(date, 2, json_file, journal_file, archive_file)
+        self.assertEqual(months, ["March 2019"])
+        self.assertEqual(ShoppingStatsKeeper.archive_old_months(date, 2, json_file, journal_file, archive_file), [])
+
+        data = ShoppingStatsKeeper.load_json(json_file, journal_file)
+        self.assertEqual(sorted(data["weekly"]), ["April 2019", "May 2019"])
+        self.assertEqual(data["archived"], ["March 2019"])
+        self.assertEqual(data["running"]["March 2019"], [2, 910, 24, 68])
+        self.assertEqual(data["average"]["March 2019"], [455, 12, 34, 910])
+        self.assertEqual(ShoppingStatsKeeper.check_aggregates(data), [])
+        self.assertEqual(ShoppingStatsKeeper.rebuild_aggregates(data)["running"]["March 2019"], [2, 910, 24, 68])
+        self.assertEqual(
+            ShoppingStatsKeeper.read_archive(archive_file), {"March 2019": [[400, 10, 30], [510, 14, 38]]}
+        )
+        self.assertEqual(
+            ShoppingStatsKeeper.compute_report("no", "PLN", "500", data, date).msg_content,
+            self.long_message.replace("1600", "910")
+        )
+
+        # an entry added late to an archived month is archived with the others
+        ShoppingStatsKeeper.save_new_entry(datetime.date(2019, 3, 30), data, [90, 0, 2], journal_file)
+        ShoppingStatsKeeper.archive_old_months(date, 2, json_file, journal_file, archive_file)
+        self.assertEqual(len(ShoppingStatsKeeper.read_archive(archive_file)["March 2019"]), 3)
+
+        ShoppingStatsKeeper.save_new_entry(datetime.date(2019, 3, 31), data, [10, 0, 0], journal_file)
+        self.assertEqual(
+            ShoppingStatsKeeper.restore_months(None, json_file, journal_file, archive_file), ["March 2019"]
+        )
+        data = ShoppingStatsKeeper.load_json(json_file, journal_file)
+        self.assertEqual(
+            data["weekly"]["March 2019"], [[400, 10, 30], [510, 14, 38], [90, 0, 2], [10, 0, 0]]
+        )
+        self.assertEqual(data["archived"], [])
+        self.assertEqual(ShoppingStatsKeeper.read_archive(archive_file), {})
+        self.assertEqual(ShoppingStatsKeeper.check_aggregates(data), [])
+
+        self.assertEqual(ShoppingStatsKeeper.keep_months_of({"keep_months": 24}), 24)
+        self.assertIsNone(ShoppingStatsKeeper.keep_months_of(self.settings))
+        for keep_months in (1, "24", True, 6.5):
+            with self.assertRaises(ValueError):
+                ShoppingStatsKeeper.keep_months_of({"keep_months": keep_months})
+
+    def test_report_cache(self):
+        """Is an unchanged report reused and a changed one made again?"""
+
+        date = datetime.date(2019, 5, 8)
+        ShoppingStatsKeeper.forget_reports()
+        first = ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date, tenant="a")
+
+        self.data["average"]["April 2019"] = [0, 0, 0, 0]
+        self.assertIs(ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date, tenant="a"), first)
+        self.assertEqual(self.data["average"]["April 2019"], [234, 15, 27, 702])
+
+        self.assertIsNot(ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date, tenant="b"), first)
+        self.assertIsNot(ShoppingStatsKeeper.compute_report("no", "PLN", "900", self.data, date, tenant="a"), first)
+
+        # the same numbers in another household's dictionary
+        other = copy.deepcopy(self.data)
+        self.assertIsNot(ShoppingStatsKeeper.compute_report("no", "PLN", "500", other, date),
+                         ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date))
+
+        ShoppingStatsKeeper.save_new_entry(datetime.date(2019, 4, 30), self.data, [10, 0, 0])
+        second = ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date, tenant="a")
+        self.assertEqual(second.num_of_entries, 4)
+
+        # the stats kept by load_json don't make every report a new one
+        ShoppingStatsKeeper.rebuild_stats(self.data)
+        self.assertEqual(len(ShoppingStatsKeeper._report_cache), 0)
+        third = ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date, tenant="a")
+        for _ in range(2):
+            self.assertIs(ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date, tenant="a"), third)
+        self.assertEqual(len(ShoppingStatsKeeper._report_cache), 1)
+
+        # the unusual values depend on the month stats
+        self.data["average"]["May 2019"] = [50, 5, 5, 100]
+        ShoppingStatsKeeper.add_month_stats(self.data, ShoppingStatsKeeper.month_key(datetime.date(2019, 5, 1)))
+        self.assertIsNot(ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date, tenant="a"), third)
+
+    def test_chart_cache(self):
+        """Is a chart with the same content found instead of drawn again?"""
+
+        chart_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(chart_dir.cleanup)
+        date = datetime.date(2019, 5, 8)
+
+        path, months, series = ShoppingStatsKeeper.chart_path(self.data, date, "PLN", chart_dir=chart_dir.name)
+        self.assertEqual(months, ["January 2019", "February 2019", "March 2019", "April 2019"])
+        self.assertEqual(series[3], [600, 900, 1600, 2000])
+        self.assertEqual(ShoppingStatsKeeper.chart_path(self.data, date, "PLN", chart_dir=chart_dir.name)[0], path)
+        self.assertNotEqual(ShoppingStatsKeeper.chart_path(self.data, date, "EUR", chart_dir=chart_dir.name)[0], path)
+
+        with open(path, "wb") as f:
+            f.write(b"cached")
+        self.assertEqual(ShoppingStatsKeeper.render_graph(self.data, date, "PLN", chart_dir=chart_dir.name), path)
+
+        msg = ShoppingStatsKeeper.make_email("Report", "test@example.com", chart=path)
+        attachment, = msg.iter_attachments()
+        self.assertEqual(attachment.get_content_type(), "image/png")
+        self.assertEqual(attachment.get_content(), b"cached")
+
+        with self.assertRaises(KeyError):
+            ShoppingStatsKeeper.chart_path(self.data, date, "PLN", months=5)
+
+    @unittest.skipUnless(importlib.util.find_spec("matplotlib"), "matplotlib is not installed")
+    def test_render_graph(self):
+        """Is the chart drawn to a file without a screen?"""
+
+        chart_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(chart_dir.cleanup)
+
+        path = ShoppingStatsKeeper.render_graph(
+            self.data, datetime.date(2019, 5, 8), "PLN", "svg", chart_dir=chart_dir.name
+        )
+        with open(path) as f:
+            self.assertIn("<svg", f.read())
+
+    def test_render_graphs(self):
+        """Are the charts of many households found or drawn, serially or in worker processes?"""
+
+        root, directories = self.make_households(("a", self.data), ("b", self.short_data))
+        chart_dir = os.path.join(root, "charts")
+        date = datetime.date(2019, 5, 8)
+
+        # already drawn, so matplotlib isn't needed
+        path = ShoppingStatsKeeper.chart_path(self.data, date, "PLN", chart_dir=chart_dir)[0]
+        os.makedirs(chart_dir)
+        with open(path, "wb") as f:
+            f.write(b"cached")
+
+        for workers in (1, 2):
+            self.assertEqual(
+                ShoppingStatsKeeper.render_graphs(directories, [date], chart_dir=chart_dir, workers=workers),
+                {(directories[0], date): path, (directories[1], date): None}
+            )
+
+    def test_backfill(self):
+        """Are the averages of all finished months computed, in every household?"""
+
+        self.data["weekly"]["February 2019"] = [[240, 88, 99], [240, 88, 99], [240, 88, 99]]
+        self.data["weekly"]["January 2019"] = [[100, 0, 0]]
+
+        changed = ShoppingStatsKeeper.backfill_averages(self.data, datetime.date(2019, 5, 8))
+        self.assertEqual(changed, ["January 2019", "February 2019", "April 2019"])
+        self.assertEqual(self.data["average"]["January 2019"], [100, 0, 0, 100])
+        self.assertEqual(self.data["average"]["February 2019"], [240, 88, 99, 720])
+        self.assertEqual(self.data["average"]["April 2019"], [234, 15, 27, 702])
+        self.assertNotIn("May 2019", changed)
+        self.assertEqual(ShoppingStatsKeeper.backfill_averages(self.data, datetime.date(2019, 5, 8)), [])
+
+        root, directories = self.make_households(("a", self.data), ("b", self.short_data))
+
+        result = ShoppingStatsKeeper.backfill_tenants(root, datetime.date(2019, 5, 8), 2)
+        self.assertEqual(list(result.values()), [[], ["April 2019"]])
+        with open(os.path.join(directories[1], "data.json")) as f:
+            self.assertEqual(json.load(f)["average"], {"April 2019": [162, 36, 42, 323]})
+
+    def test_concurrent_writers(self):
+        """Is no entry lost when many processes add entries at the same time?"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        processes = [
+            multiprocessing.Process(target=add_entries, args=(directory.name, writer))
+            for writer in range(8)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        data = ShoppingStatsKeeper.load_json(
+            os.path.join(directory.name, "data.json"), os.path.join(directory.name, "data.journal")
+        )
+        self.assertEqual(
+            sorted(data["weekly"]["May 2019"]),
+            sorted([writer, i, 0] for writer in range(8) for i in range(30))
+        )
+        self.assertEqual(data["running"]["May 2019"][0], 240)
+        self.assertFalse([name for name in os.listdir(directory.name) if name.endswith(".tmp")])
+
+        shard_dir = os.path.join(directory.name, "shards")
+        processes = [
+            multiprocessing.Process(target=add_shard_entries, args=(shard_dir, writer))
+            for writer in range(8)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        data = ShoppingStatsKeeper.load_shards(shard_dir, [ShoppingStatsKeeper.parse_month("May 2019")])
+        self.assertEqual(len(data["weekly"]["May 2019"]), 240)
+        self.assertEqual(data["running"]["May 2019"][0], 240)
                                                                                                            
 if __name__ == '__main__':
     unittest.main()
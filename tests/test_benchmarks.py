@@ -0,0 +1,38 @@
+import benchmarks
+import datetime
+import unittest
+from unittest.mock import patch
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_make_history(self):
+        """Does the generated history have every month and its average?"""
+
+        data = benchmarks.make_history(2, 8, datetime.date(2019, 5, 8))
+
+        self.assertEqual(len(data["weekly"]), 24)
+        self.assertEqual(list(data["weekly"])[0], "May 2017")
+        self.assertEqual(list(data["weekly"])[-1], "April 2019")
+        self.assertEqual(data["average"].keys(), data["weekly"].keys())
+
+    def test_run_and_compare(self):
+        """Are all stages timed and the slower ones found?"""
+
+        with patch('builtins.print'):
+            results = benchmarks.run(years=[1], trips=[4], tenants=2, repeat=1)
+        stages = [result["stage"] for result in results["results"]]
+        self.assertEqual(
+            stages,
+            [
+                "load_json", "save_new_entry", "do_statistics", "cached_report", "graph_series", "save_to_json",
+                "load_binary", "save_binary", "cli_add", "run_reports"
+            ]
+        )
+
+        self.assertEqual([gain[:2] for gain in benchmarks.binary_gains(results)], [(1, 4)])
+        self.assertEqual(benchmarks.compare(results, results), [])
+        faster = {"results": [dict(result, seconds=result["seconds"] / 2) for result in results["results"]]}
+        self.assertEqual(len(benchmarks.compare(results, faster, tolerance=0.5)), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import binary_snapshot
+import json
+import os
+import ShoppingStatsKeeper
+import unittest
+
+class TestBinarySnapshot(unittest.TestCase):
+
+    def setUp(self):
+
+        self.data = {
+            "weekly": {
+                "December 2018": [],
+                "April 2019": [[123, 23, 23], [456, 23, 34], [123, 0, 23]],
+                "May 2019": [[145, 23, 23], [1, 2, 3]]
+            },
+            "average": {
+                "January 2019": [120, 55, 44, 600], "February 2019": [240, 88, 99, 900],
+                "March 2019": [455, 12, 34, 1600], "April 2019": [700, 23, 34, 2000]
+            }
+        }
+
+    def test_round_trip(self):
+        """Does the binary format give back exactly the same dictionary?"""
+
+        content = binary_snapshot.dumps(self.data)
+
+        self.assertTrue(binary_snapshot.is_binary(content))
+        self.assertEqual(binary_snapshot.loads(content), self.data)
+
+    def test_month_columns(self):
+        """Can a month be read from the buffer without copying it?"""
+
+        content = binary_snapshot.dumps(self.data)
+        index, entries_offset, width, version = binary_snapshot.read_index(content)
+        key, first, count, in_weekly, average, running = index[-1]
+
+        self.assertEqual(ShoppingStatsKeeper.month_name(key), "May 2019")
+        self.assertTrue(in_weekly)
+        self.assertIsNone(average)
+        self.assertIsNone(running)
+        self.assertEqual((width, version), (3, binary_snapshot.VERSION))
+        columns = binary_snapshot.month_columns(content, first, count, entries_offset)
+        self.assertEqual([list(column.cast("i")) for column in columns], [[145, 1], [23, 2], [23, 3]])
+
+    def test_sizes(self):
+        """Are amounts stored in 4 bytes, and in 8 only when they need it?"""
+
+        small = binary_snapshot.dumps(self.data)
+        self.assertEqual(binary_snapshot.read_index(small)[3], binary_snapshot.VERSION)
+
+        self.data["weekly"]["May 2019"].append([2 ** 40, 0, 0])
+        ShoppingStatsKeeper.rebuild_aggregates(self.data)
+        content = binary_snapshot.dumps(self.data)
+        self.assertEqual(binary_snapshot.read_index(content)[3], binary_snapshot.WIDE_VERSION)
+        loaded = binary_snapshot.loads(content)
+        self.assertEqual(loaded, self.data)
+        self.assertIsInstance(loaded["weekly"]["May 2019"], ShoppingStatsKeeper.MonthColumns)
+
+        # an entry too big for the 4-byte columns it was loaded into
+        month = binary_snapshot.loads(small)["weekly"]["May 2019"]
+        month.append([2 ** 40, 0, 0])
+        self.assertEqual(month.sums(), [146 + 2 ** 40, 25, 26])
+
+    def test_categories(self):
+        """Are entries with other categories kept, and older narrower ones padded?"""
+
+        data = {
+            "weekly": {"May 2019": [[100, 20, 30, 40, 10], [50, 0, 0, 50, 0]]},
+            "average": {"April 2019": [75, 10, 15, 45, 5, 150]}
+        }
+        self.assertEqual(binary_snapshot.loads(binary_snapshot.dumps(data)), data)
+
+        data["weekly"]["March 2019"] = [[1, 2, 3]]
+        data["average"]["March 2019"] = [1, 2, 3, 1]
+        self.assertEqual(binary_snapshot.loads(binary_snapshot.dumps(data)), dict(data, weekly={
+            "March 2019": [[1, 2, 3, 0, 0]], "May 2019": data["weekly"]["May 2019"]
+        }, average={
+            "March 2019": [1, 2, 3, 0, 0, 1], "April 2019": data["average"]["April 2019"]
+        }))
+
+        # a category added to a household with a binary data.json
+        self.addCleanup(os.remove, "test_data.ssk")
+        self.addCleanup(os.remove, "test.journal")
+        self.addCleanup(os.remove, "test.journal.lock")
+        ShoppingStatsKeeper.save_to_json("test_data.ssk", {"weekly": {"May 2019": [[10, 1, 2]]}, "average": {}})
+        ShoppingStatsKeeper.append_to_journal("test.journal", ShoppingStatsKeeper.datetime.date(2019, 5, 3), [20, 1, 2, 3])
+        ShoppingStatsKeeper.compact_journal("test_data.ssk", "test.journal")
+        self.assertEqual(
+            ShoppingStatsKeeper.load_json("test_data.ssk", "test.journal")["weekly"]["May 2019"],
+            [[10, 1, 2, 0], [20, 1, 2, 3]]
+        )
+
+    def test_archived_months(self):
+        """Are the running aggregates of archived months kept, and the others rebuilt?"""
+
+        ShoppingStatsKeeper.rebuild_aggregates(self.data)
+        self.data["running"]["March 2019"] = [2, 910, 24, 68]
+        self.data["archived"] = ["March 2019"]
+
+        self.assertEqual(binary_snapshot.loads(binary_snapshot.dumps(self.data)), self.data)
+
+    def test_load_and_save_pick_the_format(self):
+        """Are binary files read and written without being told?"""
+
+        self.addCleanup(os.remove, "test_data.json")
+        ShoppingStatsKeeper.save_to_json("test_data.json", self.data)
+        ShoppingStatsKeeper.convert_snapshot("test_data.json")
+
+        data = ShoppingStatsKeeper.load_json("test_data.json", "test.journal")
+        self.assertEqual(data["weekly"], self.data["weekly"])
+        self.assertEqual(data["average"], self.data["average"])
+
+        ShoppingStatsKeeper.save_new_entry(ShoppingStatsKeeper.datetime.date(2019, 5, 9), data, [7, 7, 7])
+        ShoppingStatsKeeper.save_to_json("test_data.json", data)
+        with open("test_data.json", "rb") as f:
+            self.assertTrue(binary_snapshot.is_binary(f.read()))
+
+        self.assertEqual(ShoppingStatsKeeper.load_json("test_data.json", "test.journal")["stats"], data["stats"])
+
+        ShoppingStatsKeeper.convert_snapshot("test_data.json", binary=False)
+        with open("test_data.json") as f:
+            self.assertEqual(json.load(f)["weekly"]["May 2019"][-1], [7, 7, 7])
+
+if __name__ == '__main__':
+    unittest.main()
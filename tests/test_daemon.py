@@ -0,0 +1,116 @@
+import daemon
+import json
+import os
+import socket
+import ShoppingStatsKeeper
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+SETTINGS = {"currency": "PLN", "vegetarian?": "no", "goal": "500"}
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.household = os.path.join(self.root, "flat1")
+        os.mkdir(self.household)
+        ShoppingStatsKeeper.save_to_json(os.path.join(self.household, 'settings.json'), SETTINGS)
+        ShoppingStatsKeeper.save_to_json(
+            os.path.join(self.household, 'data.json'),
+            {"weekly": {"April 2019": [[100, 20, 10]]}, "average": {}}
+        )
+
+    def test_requests(self):
+        """Are entries, reports and goals answered from memory and saved by a flush?"""
+
+        server = daemon.Daemon(self.root, flush_entries=1000)
+        journal_file = os.path.join(self.household, ShoppingStatsKeeper.JOURNAL_FILE)
+
+        self.assertEqual(server.handle("ADD flat1 200 30 20 2019-04-20"), "OK")
+        self.assertEqual(server.handle("add ./flat1 50 0 5 2019-05-02"), "OK")
+        self.assertEqual(server.handle("ADD flat1 -20 0 -5 2019-05-03"), "OK")
+        self.assertFalse(os.path.exists(journal_file))
+
+        reply = server.handle("REPORT flat1 2019-05-02")
+        self.assertTrue(reply.startswith("OK "))
+        report = json.loads(reply[3:])
+        self.assertEqual(report["report_month"], "April 2019")
+        self.assertEqual(report["num_of_entries"], 2)
+        self.assertEqual(report["total"], 300)
+        self.assertEqual(server.handle("REPORT flat1 2019-01-02"), "OK null")
+
+        self.assertEqual(server.handle("GOAL flat1 900"), "OK")
+        self.assertEqual(server.handle("FLUSH"), "OK 3")
+
+        data = ShoppingStatsKeeper.load_json(
+            os.path.join(self.household, 'data.json'), journal_file
+        )
+        self.assertEqual(data["weekly"]["April 2019"], [[100, 20, 10], [200, 30, 20]])
+        self.assertEqual(data["weekly"]["May 2019"], [[50, 0, 5], [-20, 0, -5]])
+        self.assertEqual(data["average"]["April 2019"], [150, 25, 15, 300])
+        with open(os.path.join(self.household, 'settings.json')) as f:
+            self.assertEqual(json.load(f)["goal"], "900")
+
+    def test_errors(self):
+        """Are bad requests answered with ERR instead of stopping the daemon?"""
+
+        server = daemon.Daemon(self.root)
+
+        self.assertEqual(server.handle(""), "ERR empty request")
+        self.assertEqual(server.handle("DANCE"), "ERR unknown command DANCE")
+        self.assertTrue(server.handle("ADD flat1").startswith("ERR usage: ADD"))
+        self.assertEqual(server.handle("ADD flat1 200 30"), "ERR flat1 needs amounts of meat, extra")
+        self.assertEqual(server.handle("ADD flat1 200 -30"), "ERR flat1 needs amounts of meat, extra")
+        self.assertTrue(server.handle("ADD flat1 ten 20 5").startswith("ERR"))
+        self.assertTrue(server.handle("ADD ../elsewhere 200 30 20").startswith("ERR"))
+        self.assertTrue(server.handle("ADD flat2 200 30 20").startswith("ERR"))
+        self.assertTrue(server.handle("GOAL flat1 lots").startswith("ERR"))
+
+        # nothing bought in April
+        os.mkdir(os.path.join(self.root, "flat2"))
+        ShoppingStatsKeeper.save_to_json(os.path.join(self.root, "flat2", 'settings.json'), SETTINGS)
+        ShoppingStatsKeeper.save_to_json(os.path.join(self.root, "flat2", 'data.json'),
+                                         {"weekly": {"April 2019": []}, "average": {}})
+        self.assertEqual(server.handle("REPORT flat2 2019-05-02"), "OK null")
+
+        with patch("ShoppingStatsKeeper.compute_report", side_effect=ZeroDivisionError("division by zero")):
+            self.assertEqual(server.handle("REPORT flat1 2019-05-02"), "ERR division by zero")
+        self.assertEqual(server.handle("PING"), "OK")
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets are needed")
+    def test_socket(self):
+        """Are pipelined requests answered in order and everything saved on STOP?"""
+
+        socket_path = os.path.join(self.root, daemon.SOCKET)
+        ready = threading.Event()
+        server = threading.Thread(
+            target=daemon.serve, args=(self.root, socket_path, ready),
+            kwargs={"flush_interval": 60}
+        )
+        server.start()
+        self.assertTrue(ready.wait(10))
+
+        with daemon.Client(socket_path) as client:
+            replies = client.pipeline(
+                [f"ADD flat1 {total} 10 5 2019-04-{day:02d}" for day, total in enumerate(range(10, 110, 10), 1)]
+                + ["PING", "DANCE"]
+            )
+            self.assertEqual(replies[:11], ["OK"] * 11)
+            self.assertTrue(replies[11].startswith("ERR"))
+            self.assertEqual(client.request("STOP"), "OK")
+        server.join(10)
+
+        self.assertFalse(server.is_alive())
+        self.assertFalse(os.path.exists(socket_path))
+        data = ShoppingStatsKeeper.load_json(
+            os.path.join(self.household, 'data.json'),
+            os.path.join(self.household, ShoppingStatsKeeper.JOURNAL_FILE)
+        )
+        self.assertEqual(len(data["weekly"]["April 2019"]), 11)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import asyncio
+import mailer
+import os
+import ShoppingStatsKeeper
+import smtplib
+import socketserver
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+class FakeSMTP:
+    """Stand-in SMTP connection recording what was sent through it."""
+
+    connections = []
+
+    def __init__(self, fail_every=0):
+        self.sent = []
+        self.fail_every = fail_every
+        FakeSMTP.connections.append(self)
+
+    def send_message(self, msg):
+        if self.fail_every and len(self.sent) % self.fail_every == self.fail_every - 1:
+            self.sent.append(None)
+            raise smtplib.SMTPServerDisconnected("connection lost")
+        self.sent.append(msg['To'])
+
+    def quit(self):
+        pass
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """A real SMTP server on localhost speaking just enough of the protocol
+    for smtplib, recording the recipients of every message it gets.
+    With 'drop_every', every drop_every-th message closes the connection
+    instead of being accepted.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_every=0):
+        super().__init__(("127.0.0.1", 0), LocalSMTPHandler)
+        self.drop_every = drop_every
+        self.received = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def connect(self):
+        return smtplib.SMTP(*self.server_address, timeout=5)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply("220 localhost ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().rstrip("\r\n")
+            command = line[:4].upper()
+            if not line or command == "QUIT":
+                self.reply("221 bye")
+                return
+            if command == "RCPT":
+                recipients.append(line.partition(":")[2].strip("<> "))
+            if command == "DATA":
+                self.reply("354 go ahead")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.lock:
+                    count = len(self.server.received) + 1
+                    drop = self.server.drop_every and count % self.server.drop_every == 0
+                    if not drop:
+                        self.server.received.extend(recipients)
+                    else:
+                        self.server.drop_every = 0
+                if drop:
+                    return
+                recipients = []
+                self.reply("250 accepted")
+            else:
+                self.reply("250 ok")
+
+class TestMailer(unittest.TestCase):
+
+    def setUp(self):
+        FakeSMTP.connections = []
+        self.outbox = tempfile.TemporaryDirectory()
+        self.addCleanup(self.outbox.cleanup)
+        self.messages = [
+            ShoppingStatsKeeper.make_email(f"Report {i}", f"user{i}@example.com") for i in range(25)
+        ]
+
+    def test_deliver_batches(self):
+        """Are all messages sent over a few reused connections?"""
+
+        sent, failed = asyncio.run(mailer.deliver(
+            self.messages, FakeSMTP, connections=2, batch_size=10, outbox=self.outbox.name
+        ))
+
+        self.assertEqual((sent, failed), (25, []))
+        self.assertLessEqual(len(FakeSMTP.connections), 4)
+        self.assertTrue(all(len(smtp.sent) <= 10 for smtp in FakeSMTP.connections))
+        self.assertEqual(
+            sorted(to for smtp in FakeSMTP.connections for to in smtp.sent),
+            sorted(f"user{i}@example.com" for i in range(25))
+        )
+
+    def test_retry_and_outbox(self):
+        """Are failures retried, and kept in the outbox when retries run out?"""
+
+        sent, failed = asyncio.run(mailer.deliver(
+            self.messages[:6], lambda: FakeSMTP(fail_every=2), connections=1,
+            retries=1, backoff=0, outbox=self.outbox.name
+        ))
+        self.assertEqual((sent, failed), (6, []))
+
+        sent, failed = asyncio.run(mailer.deliver(
+            self.messages[:2], lambda: FakeSMTP(fail_every=1), connections=2,
+            retries=2, backoff=0, outbox=self.outbox.name
+        ))
+        self.assertEqual((sent, len(failed)), (0, 2))
+        self.assertEqual(len(os.listdir(self.outbox.name)), 2)
+
+        FakeSMTP.connections = []
+        self.assertEqual(mailer.resend_outbox(self.outbox.name, connect=FakeSMTP), 2)
+        self.assertEqual(os.listdir(self.outbox.name), [])
+        self.assertEqual(
+            sorted(to for smtp in FakeSMTP.connections for to in smtp.sent),
+            ["user0@example.com", "user1@example.com"]
+        )
+
+    def test_resend_interrupted(self):
+        """Are the messages not sent yet still in the outbox when resending stops half way?"""
+
+        for msg in self.messages[:3]:
+            mailer.save_to_outbox(self.outbox.name, msg)
+
+        class CrashingSMTP(FakeSMTP):
+            def send_message(self, msg):
+                if FakeSMTP.connections[0].sent:
+                    raise KeyboardInterrupt
+                super().send_message(msg)
+
+        with self.assertRaises(KeyboardInterrupt):
+            mailer.resend_outbox(self.outbox.name, connect=CrashingSMTP, connections=1)
+        self.assertEqual(len(os.listdir(self.outbox.name)), 2)
+
+        self.assertEqual(
+            mailer.resend_outbox(self.outbox.name, connect=lambda: FakeSMTP(fail_every=1), retries=0), 0
+        )
+        self.assertEqual(len(os.listdir(self.outbox.name)), 2)
+        self.assertEqual(mailer.resend_outbox(self.outbox.name, connect=FakeSMTP), 2)
+        self.assertEqual(os.listdir(self.outbox.name), [])
+
+    def test_local_server(self):
+        """Are the messages delivered to a real SMTP server, also when it drops a connection?"""
+
+        server = LocalSMTPServer(drop_every=5)
+        self.addCleanup(server.stop)
+
+        sent, failed = asyncio.run(mailer.deliver(
+            self.messages, server.connect, connections=3, batch_size=4, backoff=0, outbox=self.outbox.name
+        ))
+
+        self.assertEqual((sent, failed), (25, []))
+        self.assertEqual(sorted(server.received), sorted(f"user{i}@example.com" for i in range(25)))
+        self.assertGreaterEqual(server.connections, 7)
+
+    def test_other_errors(self):
+        """Does a message failing with another error go to the outbox without stopping the rest?"""
+
+        class PickySMTP(FakeSMTP):
+            def send_message(self, msg):
+                if msg['To'] == "user3@example.com":
+                    raise UnicodeEncodeError("ascii", "ł", 0, 1, "not ascii")
+                super().send_message(msg)
+
+        sent, failed = asyncio.run(mailer.deliver(
+            self.messages[:6], PickySMTP, connections=1, backoff=0, outbox=self.outbox.name
+        ))
+        self.assertEqual((sent, len(failed)), (5, 1))
+        self.assertEqual(len(os.listdir(self.outbox.name)), 1)
+
+    def test_cli(self):
+        """Do 'reports --email' and 'resend' send through mailer?"""
+
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        data = {
+            "weekly": {"April 2019": [[123, 23, 23], [200, 50, 60]]},
+            "average": {}
+        }
+        settings = {"currency": "PLN", "vegetarian?": "no", "goal": "800"}
+        for name in ("a", "b"):
+            os.mkdir(os.path.join(root.name, name))
+            ShoppingStatsKeeper.save_to_json(
+                os.path.join(root.name, name, "settings.json"), dict(settings, email=f"{name}@example.com")
+            )
+            ShoppingStatsKeeper.save_to_json(os.path.join(root.name, name, "data.json"), data)
+
+        server = LocalSMTPServer()
+        self.addCleanup(server.stop)
+        for msg in self.messages[:2]:
+            mailer.save_to_outbox(self.outbox.name, msg)
+
+        with patch.object(ShoppingStatsKeeper, "today", ShoppingStatsKeeper.datetime.date(2019, 5, 8)), \
+                patch("mailer.smtp_ssl_connection", server.connect), patch("builtins.print"):
+            ShoppingStatsKeeper.cli(["reports", root.name, "--workers", "1", "--email"])
+            self.assertEqual(sorted(server.received), ["a@example.com", "b@example.com"])
+
+            ShoppingStatsKeeper.cli(["resend", "--outbox", self.outbox.name])
+        self.assertEqual(sorted(server.received[2:]), ["user0@example.com", "user1@example.com"])
+        self.assertEqual(os.listdir(self.outbox.name), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import datetime
+import os
+import ShoppingStatsKeeper
+import sqlite_storage
+import unittest
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+
+        ShoppingStatsKeeper.forget_reports()
+        self.data = {
+            "weekly": {
+                "December 2018": [[10, 1, 1]],
+                "April 2019": [[123, 23, 23], [456, 23, 34], [123, 0, 23]],
+                "May 2019": [[145, 23, 23], [1, 2, 3]]
+            },
+            "average": {
+                "January 2019": [120, 55, 44, 600], 'February 2019': [240, 88, 99, 900],
+                'March 2019': [455, 12, 34, 1600]
+            }
+        }
+
+        ShoppingStatsKeeper.save_to_json("test_data.json", self.data)
+        self.conn = sqlite_storage.migrate_json("test_data.json", ":memory:", "test.journal")
+        self.addCleanup(os.remove, "test_data.json")
+        self.addCleanup(self.conn.close)
+
+    def test_load_report_window(self):
+        """Are only the months of the report loaded, with their aggregates?"""
+
+        window = sqlite_storage.load_report_window(self.conn, datetime.date(2019, 5, 8))
+
+        self.assertEqual(
+            window["weekly"],
+            {
+                "April 2019": [[123, 23, 23], [456, 23, 34], [123, 0, 23]],
+                "May 2019": [[145, 23, 23], [1, 2, 3]]
+            }
+        )
+        self.assertEqual(window["average"], self.data["average"])
+        self.assertEqual(window["running"]["April 2019"], [3, 702, 46, 80])
+        self.assertTrue(sqlite_storage.has_history(self.conn, datetime.date(2019, 4, 1)))
+        self.assertFalse(sqlite_storage.has_history(self.conn, datetime.date(2018, 12, 1)))
+
+    def test_report_is_the_same(self):
+        """Does a report made from the database match the one from data.json?"""
+
+        date = datetime.date(2019, 5, 8)
+        from_json = ShoppingStatsKeeper.compute_report("no", "PLN", "500", self.data, date)
+
+        ShoppingStatsKeeper.forget_reports()
+        window = sqlite_storage.load_report_window(self.conn, date)
+        from_sqlite = ShoppingStatsKeeper.compute_report("no", "PLN", "500", window, date)
+        self.assertEqual(from_sqlite, from_json)
+
+        sqlite_storage.save_averages(self.conn, window)
+        sqlite_storage.save_entry(self.conn, datetime.date(2019, 5, 9), [5, 0, 1])
+        window = sqlite_storage.load_report_window(self.conn, date)
+        self.assertEqual(window["average"]["April 2019"], [234, 15, 27, 702])
+        self.assertEqual(window["running"]["May 2019"], [3, 151, 25, 27])
+
+if __name__ == '__main__':
+    unittest.main()